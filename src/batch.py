@@ -0,0 +1,270 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from collections import Counter
+from datetime import datetime
+import glob
+import itertools
+import json
+import logging
+import os
+from pathlib import Path
+import time
+
+import click
+
+import enums
+import instrumentation
+
+
+logging.basicConfig(
+    format='%(asctime)s %(name)-8s %(levelname)-8s %(message)s',
+    level=logging.INFO
+)
+
+allowed_distributors = [d.value for d in enums.Distributor]
+allowed_transactions = [t.value for t in enums.Transaction]
+allowed_granularities = [g.value for g in enums.Granularity]
+allowed_formats = ['csv', 'parquet', 'json']
+
+SERVICE_MAP_FILE = Path('data/partner_map_simplified.csv')
+
+
+def job_name(source) -> str:
+    """Name of the output directory of an input: the file name without its
+    suffix, the directory name, or for a glob pattern, the name of the last
+    directory before its first wildcard
+    """
+    path = Path(source)
+    if glob.has_magic(str(source)) and not path.exists():
+        fixed = list(itertools.takewhile(lambda part: not glob.has_magic(part), path.parts))
+        return Path(*fixed).resolve().name if fixed else Path.cwd().name
+    return path.stem if path.suffix else path.name
+
+
+def parse_input(text) -> tuple:
+    """Splits an input given as NAME=SOURCE into its job name and source.
+    Other inputs are named by `job_name`.
+    """
+    name, sep, source = text.partition('=')
+    if sep and name and source and '/' not in name and os.sep not in name and not Path(text).exists():
+        return name, source
+    return job_name(text), text
+
+
+def write_report(report, path, output_format) -> None:
+    """Writes one report, replacing any existing file atomically"""
+    tmp_path = path.with_suffix(f'.{os.getpid()}.tmp')
+    if output_format == 'csv':
+        report.to_csv(tmp_path)
+    else:
+        # parquet and json need string column names; periods become e.g. 2023Q1
+        report = report.rename(columns=str)
+        if output_format == 'parquet':
+            report.to_parquet(tmp_path)
+        else:
+            report.to_json(tmp_path, orient='split', indent=2)
+    os.replace(tmp_path, path)
+
+
+def run_job(
+        source,
+        output_dir,
+        distributor,
+        transactions,
+        granularity,
+        formats,
+        target_date=None,
+        rate_quantiles=(),
+        collect_metrics=False,
+        name=None
+    ) -> dict:
+    """Loads one input (a file, a directory or a glob pattern of the
+    statements of one account), generates its reports and writes them
+    under `output_dir/<name>/`, where `name` defaults to `job_name(source)`.
+    Returns the seconds spent in each stage.
+
+    With `collect_metrics`, for jobs run in worker processes, the job's
+    instrumentation metrics are returned too, to be merged by the parent.
+    """
+    if collect_metrics:
+        instrumentation.enable()
+        instrumentation.reset()
+
+    import cpi_prefetch
+    from data_loader import combine_earnings_reports, load_earnings_report, resolve_input_paths
+    from data_processor import add_cpi_adjusted_reports, generate_reports
+
+    stages = {}
+
+    def timed(stage, func, *args, **kwargs):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        stages[stage] = time.perf_counter() - start
+        return result
+
+    paths = resolve_input_paths(source)
+    if not paths:
+        raise FileNotFoundError(f'No files found for "{source}"')
+
+    def load():
+        reports = [load_earnings_report(p, distributor, SERVICE_MAP_FILE) for p in paths]
+        return reports[0] if len(reports) == 1 else combine_earnings_reports(reports)
+
+    data = timed('load', load)
+    # load CPI values of the data's years while the nominal reports are generated
+    cpi_prefetch.start_prefetch(data)
+    reports = timed(
+        'generate_reports', generate_reports,
+        data, transactions, adjust_for_inflation=False, granularity=granularity,
+        rate_quantiles=rate_quantiles
+    )
+    timed('adjust_for_inflation', add_cpi_adjusted_reports, reports, target_date)
+
+    job_dir = Path(output_dir) / (name or job_name(source))
+    job_dir.mkdir(parents=True, exist_ok=True)
+
+    def write():
+        for name, report in reports.items():
+            for output_format in formats:
+                write_report(report, job_dir / f'{name}.{output_format}', output_format)
+
+    timed('write', write)
+    result = {
+        'input': str(source),
+        'output': str(job_dir),
+        'files': len(paths),
+        'rows': len(data),
+        'stages': stages,
+        'seconds': sum(stages.values())
+    }
+    if collect_metrics:
+        result['metrics'] = instrumentation.snapshot()
+    return result
+
+
+@click.command()
+@click.argument('inputs', nargs=-1, required=True)
+@click.option('--distributor', type=click.Choice(allowed_distributors + ['auto']), default='auto',
+              show_default=True, help='Export format of all inputs; auto detects it from each file\'s header')
+@click.option('--transaction', 'transactions', type=click.Choice(allowed_transactions),
+              multiple=True, default=['stream'], show_default=True,
+              help='Transaction types to report on; repeat for several')
+@click.option('--granularity', type=click.Choice(allowed_granularities), default='year',
+              show_default=True, help='Time period of each report column')
+@click.option('--format', 'formats', type=click.Choice(allowed_formats), multiple=True,
+              default=['csv'], show_default=True, help='Output formats; repeat for several')
+@click.option('--output-dir', type=click.Path(file_okay=False), default='reports',
+              show_default=True, help='Directory to write reports to, one subdirectory per input')
+@click.option('--workers', type=click.IntRange(min=1), default=1, show_default=True,
+              help='Number of inputs processed in parallel')
+@click.option('--rate-quantile', 'rate_quantiles', type=click.FloatRange(0, 1), multiple=True,
+              help='Also write reports of this quantile of per-transaction rates, '
+                   'e.g. 0.5 for rates_p50; repeat for several')
+@click.option('--cpi-target-date', type=click.DateTime(formats=['%Y-%m-%d']), default=None,
+              help='Date whose dollar value CPI-adjusted reports use (default: today)')
+@click.option('--timings', type=click.Path(dir_okay=False), default=None,
+              help='File to write the per-stage timing of each input to, as JSON')
+@click.option('--metrics', type=click.Path(dir_okay=False), default=None,
+              help='File to write pipeline metrics of all inputs to '
+                   '(Prometheus text if it ends in .prom, JSON otherwise)')
+def main(
+        inputs,
+        distributor,
+        transactions,
+        granularity,
+        formats,
+        output_dir,
+        workers,
+        rate_quantiles,
+        cpi_target_date,
+        timings,
+        metrics
+    ) -> None:
+    """Generate counts, earnings and rates reports, nominal and adjusted for
+    inflation, for each of INPUTS without rendering any plots.
+
+    Each input is a file, a directory or a quoted glob pattern holding the
+    statements of one account, and is written to its own subdirectory of
+    the output directory. The subdirectory is named after the file, the
+    directory or the directory of the pattern, or given as NAME=INPUT.
+    """
+    jobs = [parse_input(text) for text in inputs]
+    repeated = [name for name, count in Counter(name for name, _ in jobs).items() if count > 1]
+    if repeated:
+        raise click.UsageError(
+            f'Several inputs would write to the same output directory: {", ".join(repeated)}. '
+            'Name them with NAME=INPUT.'
+        )
+
+    if metrics:
+        instrumentation.enable()
+    if workers == 1:
+        # CPI values load in the background while the first input loads.
+        # Worker processes are not forked with a prefetch running: each
+        # starts its own once its input is loaded.
+        import cpi_prefetch
+        cpi_prefetch.start_prefetch()
+
+    options = dict(
+        output_dir=output_dir,
+        distributor=distributor,
+        transactions=transactions,
+        granularity=granularity,
+        formats=formats,
+        target_date=cpi_target_date.date() if cpi_target_date else None,
+        rate_quantiles=rate_quantiles
+    )
+    results = []
+    failures = []
+
+    def record(source, get_result):
+        try:
+            result = get_result()
+        except Exception as e:
+            logging.error(f'{source}: failed: {e}')
+            failures.append({'input': str(source), 'error': str(e)})
+            return
+        if 'metrics' in result:
+            instrumentation.merge(result.pop('metrics'))
+        stages = ', '.join(f'{stage} {seconds:.2f}s' for stage, seconds in result['stages'].items())
+        logging.info(f'{source}: {result["rows"]} rows, {stages}')
+        results.append(result)
+
+    start = time.perf_counter()
+    if workers == 1:
+        for name, source in jobs:
+            record(source, lambda: run_job(source, name=name, **options))
+    else:
+        logging.info(f'Processing {len(inputs)} inputs with {workers} workers')
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {
+                pool.submit(run_job, source, name=name, collect_metrics=bool(metrics), **options): source
+                for name, source in jobs
+            }
+            for future in as_completed(futures):
+                record(futures[future], future.result)
+    elapsed = time.perf_counter() - start
+
+    logging.info(
+        f'Wrote reports for {len(results)} of {len(inputs)} inputs to "{output_dir}" in {elapsed:.2f}s'
+    )
+    if timings:
+        with open(timings, 'w', encoding='utf-8') as f:
+            json.dump({
+                'timestamp': datetime.now().isoformat(timespec='seconds'),
+                'workers': workers,
+                'seconds': elapsed,
+                'results': results,
+                'failures': failures
+            }, f, indent=2)
+        logging.info(f'Timings saved to {timings}')
+
+    if metrics:
+        instrumentation.write_metrics(metrics)
+        logging.info(f'Metrics saved to {metrics}')
+
+    if failures:
+        raise click.ClickException(f'{len(failures)} of {len(inputs)} inputs failed')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+from datetime import date, datetime
+import json
+import logging
+import os
+from pathlib import Path
+import platform
+import tempfile
+import time
+import tracemalloc
+
+import click
+
+# CPI values come from the local cache and bundled snapshot, never the network
+os.environ.setdefault('CPI_OFFLINE', '1')
+
+from data_loader import load_earnings_report
+from data_processor import adjust_report_for_inflation, generate_reports
+from generate_sample_data import write_sample_data
+import enums
+from plotting import generate_echarts_rates_plot_options
+
+
+logging.basicConfig(
+    format='%(asctime)s %(name)-8s %(levelname)-8s %(message)s',
+    level=logging.INFO
+)
+
+allowed_distributors = [d.value for d in enums.Distributor]
+
+
+def measure(func, *args, **kwargs):
+    """Runs a function twice: once timed, and once with tracemalloc to find
+    the peak memory allocated while it ran, so tracing does not slow down
+    the timed run. Returns the result of the timed run, its elapsed seconds
+    and the peak memory in MB.
+    """
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    try:
+        func(*args, **kwargs)
+        _current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, elapsed, peak / 1e6
+
+
+def benchmark_pipeline(filepath, distributor, service_map_file) -> list:
+    """Times and memory-profiles each stage of the load -> report -> plot
+    pipeline on one file
+    """
+    stages = []
+
+    def run(stage, func, *args, **kwargs):
+        result, seconds, peak_mb = measure(func, *args, **kwargs)
+        logging.info(f'{stage}: {seconds:.3f}s, peak {peak_mb:.1f} MB')
+        stages.append({'stage': stage, 'seconds': seconds, 'peak_mb': peak_mb})
+        return result
+
+    data = run('load_earnings_report', load_earnings_report, filepath, distributor, service_map_file)
+    reports = run('generate_reports', generate_reports, data, ['stream'], adjust_for_inflation=False)
+    adjusted = run('adjust_report_for_inflation', adjust_report_for_inflation, reports['rates'], date.today())
+    run('generate_echarts_rates_plot_options', generate_echarts_rates_plot_options, adjusted)
+    return stages
+
+
+@click.command()
+@click.option('--rows', type=click.IntRange(min=1), multiple=True, default=[10_000, 100_000],
+              show_default=True, help='Dataset sizes to benchmark; repeat for several sizes')
+@click.option('--distributor', type=click.Choice(allowed_distributors), multiple=True,
+              default=allowed_distributors, show_default=True, help='Export formats to benchmark')
+@click.option('--seed', type=int, default=0, show_default=True, help='Random seed for generated data')
+@click.option('--data-dir', type=click.Path(file_okay=False), default=None,
+              help='Keep generated datasets in this directory instead of a temporary one')
+@click.option('--output', type=click.Path(dir_okay=False), default='benchmark_results.json',
+              show_default=True, help='File to write results to, as JSON')
+def main(rows, distributor, seed, data_dir, output) -> None:
+    """Benchmark the pipeline on generated datasets of several sizes"""
+    service_map_file = Path('data/partner_map_simplified.csv')
+    results = []
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dataset_dir = Path(data_dir or tmp_dir)
+        dataset_dir.mkdir(parents=True, exist_ok=True)
+
+        for dist in distributor:
+            for n_rows in rows:
+                filepath = dataset_dir / f'sample_{dist}_{n_rows}.txt'
+                if not filepath.exists():
+                    logging.info(f'Generating {n_rows} rows of {dist} data...')
+                    write_sample_data(filepath, n_rows, distributor=dist, seed=seed)
+
+                logging.info(f'Benchmarking {dist} with {n_rows} rows...')
+                for stage in benchmark_pipeline(filepath, dist, service_map_file):
+                    results.append({
+                        'distributor': dist,
+                        'rows': n_rows,
+                        'file_mb': filepath.stat().st_size / 1e6,
+                        **stage
+                    })
+
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'cpu_count': os.cpu_count(),
+            'seed': seed,
+            'results': results
+        }, f, indent=2)
+    logging.info(f'Results saved to {output}')
+
+
+if __name__ == '__main__':
+    main()
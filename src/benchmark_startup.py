@@ -0,0 +1,84 @@
+from datetime import datetime
+import json
+import logging
+import os
+from pathlib import Path
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+import click
+
+
+logging.basicConfig(
+    format='%(asctime)s %(name)-8s %(levelname)-8s %(message)s',
+    level=logging.INFO
+)
+
+SRC_DIR = Path(__file__).resolve().parent
+PROJECT_ROOT = SRC_DIR.parent
+
+# Commands timed by default, each run in a fresh interpreter
+STARTUP_COMMANDS = {
+    'cli --help': [str(SRC_DIR / 'main.py'), '--help'],
+    'import main': ['-c', 'import main'],
+    'import data_processor': ['-c', 'import data_processor'],
+    'import plotting': ['-c', 'import plotting'],
+}
+
+
+def time_command(args, repeat) -> list:
+    """Runs `python <args>` `repeat` times from the project root, returning
+    the wall-clock seconds of each run
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        p for p in [str(SRC_DIR), os.environ.get('PYTHONPATH')] if p
+    ))
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, *args], cwd=PROJECT_ROOT, env=env, check=True,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+@click.command()
+@click.option('--repeat', type=click.IntRange(min=1), default=5, show_default=True,
+              help='Number of runs of each command; the median is reported')
+@click.option('--max-seconds', type=click.FloatRange(min=0), default=None,
+              help='Exit with an error if `cli --help` takes longer than this (median)')
+@click.option('--output', type=click.Path(dir_okay=False), default='benchmark_startup.json',
+              show_default=True, help='File to write results to, as JSON')
+def main(repeat, max_seconds, output) -> None:
+    """Benchmark the startup time of the CLI and the main modules"""
+    results = []
+    for name, args in STARTUP_COMMANDS.items():
+        timings = time_command(args, repeat)
+        median = statistics.median(timings)
+        logging.info(f'{name}: {median:.3f}s (min {min(timings):.3f}s)')
+        results.append({'command': name, 'median_seconds': median, 'seconds': timings})
+
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'repeat': repeat,
+            'results': results
+        }, f, indent=2)
+    logging.info(f'Results saved to {output}')
+
+    cli_seconds = results[0]['median_seconds']
+    if max_seconds is not None and cli_seconds > max_seconds:
+        raise click.ClickException(
+            f'CLI startup took {cli_seconds:.3f}s, over the budget of {max_seconds:.3f}s'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -1,42 +1,172 @@
+import ast
+import functools
+import inspect
 import json
-import os
+import re
+import sqlite3
+import threading
+import time
 from pathlib import Path
 
+import instrumentation
 from logger import logger
 
 
 PROJECT_ROOT = Path(__file__).resolve().parent.parent
 CACHE_DIR = PROJECT_ROOT / "cache"
-CACHE_FILE = CACHE_DIR / "cpi_cache.json"
+CACHE_DB = CACHE_DIR / "cache.sqlite3"
+LEGACY_CACHE_FILE = CACHE_DIR / "cpi_cache.json"
 
-def load_cache():
-    """Reads the cache file from disk"""
-    if os.path.exists(CACHE_FILE):
-        with open(CACHE_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    else:
-        return {}
+DEFAULT_MAX_ENTRIES = 10_000
 
-def save_cache(cache_data):
-    """Saves a new cache file to disk"""
-    with open(CACHE_FILE, "w", encoding="utf-8") as f:
-        json.dump(cache_data, f)
+_LEGACY_KEY_PATTERN = re.compile(r'^(\w+?)_(\(.*\))_(\{.*\})$')
+_local = threading.local()
 
-def disk_cache(func):
-    """Decorator to save and load function results to and from the disk"""
-    cache = load_cache()
 
+def connect(db_path=CACHE_DB) -> sqlite3.Connection:
+    """Returns this thread's connection to the cache database, creating the
+    database if needed.
+
+    The database runs in WAL mode, so several processes can read while one
+    writes, and writers wait for each other instead of failing.
+    """
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+    if db_path not in connections:
+        conn = sqlite3.connect(db_path, timeout=30.0, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS cache ('
+            ' key TEXT PRIMARY KEY,'
+            ' value TEXT NOT NULL,'
+            ' created_at REAL NOT NULL,'
+            ' expires_at REAL'
+            ')'
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS cache_created_at ON cache (created_at)')
+        conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        connections[db_path] = conn
+    return connections[db_path]
+
+
+def load_cache(key, db_path=CACHE_DB):
+    """Reads a single entry from the cache.
+    Returns a (found, value) tuple; expired entries are not found
+    """
+    row = connect(db_path).execute(
+        'SELECT value, expires_at FROM cache WHERE key = ?', (key,)
+    ).fetchone()
+    if row is None or (row[1] is not None and row[1] <= time.time()):
+        return False, None
+    return True, json.loads(row[0])
+
+
+def save_cache(key, value, ttl=None, max_entries=DEFAULT_MAX_ENTRIES, db_path=CACHE_DB):
+    """Atomically writes a single entry to the cache, then evicts expired
+    entries and the oldest entries beyond `max_entries`
+    """
+    now = time.time()
+    expires_at = now + ttl if ttl is not None else None
+    conn = connect(db_path)
+    with conn:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute(
+            'INSERT OR REPLACE INTO cache (key, value, created_at, expires_at) VALUES (?, ?, ?, ?)',
+            (key, json.dumps(value), now, expires_at)
+        )
+        conn.execute('DELETE FROM cache WHERE expires_at <= ?', (now,))
+        conn.execute(
+            'DELETE FROM cache WHERE key IN ('
+            ' SELECT key FROM cache ORDER BY created_at DESC LIMIT -1 OFFSET ?'
+            ')',
+            (max_entries,)
+        )
+
+
+def _import_legacy_cache(func, make_key, get_ttl, max_entries, db_path):
+    """Copies the results of `func` from the old JSON cache file into the
+    cache database, once per database
+    """
+    if not LEGACY_CACHE_FILE.exists():
+        return
+    conn = connect(db_path)
+    marker = f'legacy_imported:{func.__module__}.{func.__qualname__}'
+    if conn.execute('SELECT 1 FROM meta WHERE key = ?', (marker,)).fetchone():
+        return
+
+    with open(LEGACY_CACHE_FILE, "r", encoding="utf-8") as f:
+        legacy = json.load(f)
+    for legacy_key, result in legacy.items():
+        match = _LEGACY_KEY_PATTERN.match(legacy_key)
+        if not match or match.group(1) != func.__name__:
+            continue
+        args = ast.literal_eval(match.group(2))
+        kwargs = ast.literal_eval(match.group(3))
+        key = make_key(args, kwargs)
+        if not load_cache(key, db_path)[0]:
+            save_cache(key, result, get_ttl(result), max_entries, db_path)
+    conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (marker, str(time.time())))
+    logger.debug('Imported legacy cache entries for %s', func.__name__)
+
+
+def disk_cache(func=None, *, ttl=None, max_entries=DEFAULT_MAX_ENTRIES, db_path=CACHE_DB):
+    """Decorator to save and load function results to and from the disk
+
+    Results must be JSON serializable. Entries are keyed by the function's
+    qualified name and its bound arguments, so positional and keyword calls
+    share an entry. `ttl` is either a number of seconds or a function that
+    takes the result and returns a number of seconds; None never expires.
+
+    The wrapper also exposes `is_cached(*args, **kwargs)` and
+    `store(result, *args, **kwargs)`, so callers that fetch results in
+    bulk can check for and seed individual cache entries
+    """
+    if func is None:
+        return functools.partial(disk_cache, ttl=ttl, max_entries=max_entries, db_path=db_path)
+
+    signature = inspect.signature(func)
+    name = f'{func.__module__}.{func.__qualname__}'
+    imported = []
+
+    def make_key(args, kwargs):
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        return json.dumps([name, bound.arguments], sort_keys=True, default=str)
+
+    def get_ttl(result):
+        return ttl(result) if callable(ttl) else ttl
+
+    def lookup(cache_key):
+        if not imported:
+            _import_legacy_cache(func, make_key, get_ttl, max_entries, db_path)
+            imported.append(True)
+        return load_cache(cache_key, db_path)
+
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        cache_key = f"{func.__name__}_{args}_{kwargs}"
-        if cache_key in cache:
+        cache_key = make_key(args, kwargs)
+        found, result = lookup(cache_key)
+        instrumentation.record_cache(name, found)
+        if found:
             logger.debug('Retrieved results from cache')
-            return cache[cache_key]
+            return result
 
         result = func(*args, **kwargs)
-        cache[cache_key] = result
         logger.debug('Caching result to %s', cache_key)
-        save_cache(cache)
+        save_cache(cache_key, result, get_ttl(result), max_entries, db_path)
 
         return result
 
+    def is_cached(*args, **kwargs):
+        return lookup(make_key(args, kwargs))[0]
+
+    def store(result, *args, **kwargs):
+        cache_key = make_key(args, kwargs)
+        logger.debug('Caching result to %s', cache_key)
+        save_cache(cache_key, result, get_ttl(result), max_entries, db_path)
+
+    wrapper.is_cached = is_cached
+    wrapper.store = store
     return wrapper
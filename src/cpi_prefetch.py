@@ -0,0 +1,169 @@
+from datetime import date
+import threading
+import time
+
+import numpy as np
+
+from inflation import CPI_PARTIAL_YEAR_TTL, CPIIndex, get_cpi_index
+import instrumentation
+from logger import logger
+
+
+# First year prefetched before any data is loaded, the first year of the
+# bundled CPI snapshot
+DEFAULT_FIRST_YEAR = 2010
+
+# Published indexes older than this are refreshed in the background, so
+# newly published months are picked up by long-running apps
+MAX_INDEX_AGE = CPI_PARTIAL_YEAR_TTL
+
+
+def plausible_years(data=None, today=None) -> tuple:
+    """First and last year CPI values may be needed for: from the first
+    year of loaded earnings data (or DEFAULT_FIRST_YEAR) to this year, the
+    default target date of inflation-adjusted reports
+    """
+    today = today or date.today()
+    start_year, end_year = DEFAULT_FIRST_YEAR, today.year
+    if data is not None and len(data):
+        years = np.asarray(data['Year'], dtype=float)
+        if not np.isnan(years).all():
+            start_year = int(np.nanmin(years))
+            end_year = max(end_year, int(np.nanmax(years)))
+    return start_year, end_year
+
+
+def missing_cpi_years(index: CPIIndex, start_year: int, end_year: int, today=None) -> list:
+    """Years of a range, before this year, without any monthly CPI value
+    in an index
+    """
+    today = today or date.today()
+    years = np.arange(start_year, min(end_year, today.year - 1) + 1)
+    found = ~np.isnan(index.average(years, np.ones(len(years), dtype=int), 12))
+    return [int(year) for year in years[~found]]
+
+
+class CPIPrefetcher:
+    """Loads CPI values in a background thread and publishes a ready
+    `CPIIndex`, so inflation adjustments don't wait on the BLS API or the
+    disk cache.
+
+        prefetcher.start(2010, 2024)      # returns at once
+        ...
+        index = prefetcher.get_index(2015, 2023)
+
+    `get_index` returns the published index if it covers the years asked
+    for, waits for a prefetch that will cover them, and otherwise loads
+    them in the calling thread. Ranges only ever grow: each prefetch also
+    covers the years already published.
+    """
+
+    def __init__(self, series='CUUR0000SA0', max_age=MAX_INDEX_AGE):
+        self.series = series
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        # (start_year, end_year, index, built at) of the published index
+        self._published = None
+        # (start_year, end_year, thread) of the prefetch in progress
+        self._pending = None
+
+    @staticmethod
+    def _covers(entry, start_year, end_year) -> bool:
+        return entry is not None and entry[0] <= start_year and end_year <= entry[1]
+
+    def _is_fresh(self, entry) -> bool:
+        return time.monotonic() - entry[3] < self.max_age
+
+    def start(self, start_year: int, end_year: int) -> threading.Thread | None:
+        """Starts loading the CPI values of a range of years in a daemon
+        thread, unless they are already published or being loaded.
+        Returns the thread loading them, if any.
+        """
+        with self._lock:
+            published, pending = self._published, self._pending
+            if self._covers(published, start_year, end_year) and self._is_fresh(published):
+                return None
+            if self._covers(pending, start_year, end_year):
+                return pending[2]
+            for entry in (published, pending):
+                if entry is not None:
+                    start_year, end_year = min(start_year, entry[0]), max(end_year, entry[1])
+            thread = threading.Thread(
+                target=self._prefetch, args=(start_year, end_year), name='cpi-prefetch', daemon=True
+            )
+            self._pending = (start_year, end_year, thread)
+        logger.info('Prefetching CPI data for %s-%s', start_year, end_year)
+        thread.start()
+        return thread
+
+    def _prefetch(self, start_year, end_year) -> None:
+        try:
+            self._load(start_year, end_year)
+        except Exception as e:
+            logger.warning('Could not prefetch CPI data: %s', e)
+        finally:
+            with self._lock:
+                if self._pending is not None and self._pending[2] is threading.current_thread():
+                    self._pending = None
+
+    def _load(self, start_year, end_year) -> CPIIndex:
+        """Loads, validates and publishes the index of a range of years"""
+        with instrumentation.stage('cpi_load'):
+            index = get_cpi_index(start_year, end_year, self.series)
+        missing = missing_cpi_years(index, start_year, end_year)
+        if missing:
+            logger.warning('No CPI data found for %s', ', '.join(map(str, missing)))
+
+        with self._lock:
+            published = self._published
+            # never replace a wider index with a narrower one loaded meanwhile
+            if (published is None or not self._is_fresh(published)
+                    or self._covers((start_year, end_year), published[0], published[1])):
+                self._published = (start_year, end_year, index, time.monotonic())
+        return index
+
+    def get_index(self, start_year: int, end_year: int) -> CPIIndex:
+        """A `CPIIndex` covering a range of years: the published one if it
+        covers the range, otherwise one loaded by a pending prefetch or, if
+        none covers the range, in this thread. A stale published index is
+        still returned while a fresh one is loaded in the background.
+        """
+        with self._lock:
+            published, pending = self._published, self._pending
+
+        if self._covers(published, start_year, end_year):
+            instrumentation.record_cache('cpi_index', True)
+            if not self._is_fresh(published):
+                self.start(start_year, end_year)
+            return published[2]
+
+        instrumentation.record_cache('cpi_index', False)
+        if self._covers(pending, start_year, end_year):
+            pending[2].join()
+            with self._lock:
+                published = self._published
+            if self._covers(published, start_year, end_year):
+                return published[2]
+        if published is not None:
+            start_year, end_year = min(start_year, published[0]), max(end_year, published[1])
+        return self._load(start_year, end_year)
+
+    def ready(self, start_year: int, end_year: int) -> bool:
+        """Whether a published index covers a range of years"""
+        with self._lock:
+            return self._covers(self._published, start_year, end_year)
+
+
+_prefetcher = CPIPrefetcher()
+
+
+def start_prefetch(data=None) -> threading.Thread | None:
+    """Starts loading, in the background, the CPI values for the plausible
+    years of loaded earnings data, or of any data if none is given
+    """
+    return _prefetcher.start(*plausible_years(data))
+
+
+def get_index(start_year: int, end_year: int) -> CPIIndex:
+    """`CPIPrefetcher.get_index` of the application's prefetcher"""
+    return _prefetcher.get_index(start_year, end_year)
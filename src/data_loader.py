@@ -1,64 +1,651 @@
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import functools
+import glob
+import itertools
+import os
+from pathlib import Path
+import posixpath
+import re
+from xml.etree import ElementTree
+import zipfile
+
+import numpy as np
 import pandas as pd
+
+import instrumentation
 from logger import logger
 
 
-def load_cd_baby(filepath):
-    """Loader for a data file exported from CD Baby
+REPORT_AGGREGATE_KEYS = ['Company Name', 'Year', 'Month', 'Transaction Type']
+REPORT_AGGREGATE_VALUES = ['Quantity', 'Subtotal']
+
+# Columns a sale can be broken down by, besides partner and period
+DIMENSION_COLUMNS = ['Album', 'Track', 'ISRC', 'Country']
+
+CATEGORICAL_COLUMNS = [
+    'Report Date', 'Sales Date', 'Company Name Source', 'Transaction Type', 'Company Name'
+] + DIMENSION_COLUMNS
+
+# Columns `map_earnings_data` derives from the export and the service map
+MAPPED_COLUMNS = ['Year', 'Month', 'Company Name']
+
+UNKNOWN_PARTNER = 'Unknown'
+
+EXCEL_SUFFIXES = ('.xlsx', '.xlsm')
+EARNINGS_REPORT_SUFFIXES = ('.txt', '.tsv', '.csv') + EXCEL_SUFFIXES
+
+# Rows read from a spreadsheet at a time when no chunksize is given
+EXCEL_BATCH_ROWS = 50_000
+
+# Bytes read from the start of a file to find its header
+HEADER_BYTES = 8192
+
+# Namespaces of the parts of a workbook read to find its header
+XLSX_NAMESPACE = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+XLSX_RELATIONSHIP = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id'
+
+# Largest rounding error allowed when storing subtotals as float32
+FLOAT32_TOLERANCE = 5e-7
+
+
+def _iter_chunks(reader, formatter):
+    """Applies a formatter to each chunk of a chunked csv reader,
+    closing the underlying file once all chunks have been consumed
     """
-    df = pd.read_csv(
-        filepath, 
-        delimiter='\t', 
-        parse_dates=True, 
-        usecols=[1, 2, 4, 11, 12]
-    )
-    df.columns = [
-        'Sales Date',
-        'Quantity',
-        'Subtotal',
-        'Company Name Source',
-        'Transaction Type'
-    ]
-    df['Transaction Type'] = df['Transaction Type'].apply(lambda s: s.replace(' ', '_').lower())
+    with reader:
+        for chunk in reader:
+            yield formatter(chunk)
+
+
+def is_excel_file(filepath) -> bool:
+    """Whether a path, or an uploaded file with a `name`, is a spreadsheet"""
+    name = getattr(filepath, 'name', filepath)
+    return Path(str(name)).suffix.lower() in EXCEL_SUFFIXES
+
+
+def _excel_batch_frame(header, batch, usecols) -> pd.DataFrame:
+    """Builds a dataframe of the `usecols` columns (by position) of a batch
+    of rows. Date cells are written as text, as they appear in tab-separated
+    exports.
+    """
+    df = pd.DataFrame({
+        header[i]: [row[i] if i < len(row) else None for row in batch]
+        for i in usecols
+    })
+    for column in df.columns:
+        if pd.api.types.is_datetime64_any_dtype(df[column]):
+            df[column] = df[column].dt.strftime('%Y-%m-%d')
     return df
 
 
-def load_distrokid(filepath) -> pd.DataFrame:
-    """Loader for a data file exported from DistroKid
+def _excel_header(row) -> list:
+    return [str(name) if name is not None else f'Unnamed: {i}' for i, name in enumerate(row)]
+
+
+def read_excel_chunks(filepath, usecols, chunksize=EXCEL_BATCH_ROWS):
+    """Yields dataframes of at most `chunksize` rows of the `usecols`
+    columns (by name) of the first sheet of a workbook.
+
+    The workbook is opened in openpyxl's read-only mode, which streams rows
+    from the file instead of loading every cell into memory, and each batch
+    of rows is converted to columns at once.
+    """
+    import openpyxl
+
+    workbook = openpyxl.load_workbook(filepath, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            raise ValueError(f'Spreadsheet "{getattr(filepath, "name", filepath)}" is empty')
+        header = _excel_header(header)
+        positions = [header.index(name) for name in usecols]
+        while batch := list(itertools.islice(rows, chunksize)):
+            # read-only sheets can report trailing empty rows
+            batch = [row for row in batch if any(v is not None for v in row)]
+            if batch:
+                yield _excel_batch_frame(header, batch, positions)
+    finally:
+        workbook.close()
+
+
+def _first_sheet_path(archive) -> str:
+    """Path within a workbook archive of the part holding its first sheet"""
+    workbook = ElementTree.fromstring(archive.read('xl/workbook.xml'))
+    sheet = workbook.find(f'{XLSX_NAMESPACE}sheets/{XLSX_NAMESPACE}sheet')
+    relationships = ElementTree.fromstring(archive.read('xl/_rels/workbook.xml.rels'))
+    for relationship in relationships:
+        if sheet is not None and relationship.get('Id') == sheet.get(XLSX_RELATIONSHIP):
+            target = relationship.get('Target')
+            return target.lstrip('/') if target.startswith('/') else posixpath.join('xl', target)
+    return 'xl/worksheets/sheet1.xml'
+
+
+def _column_position(reference) -> int:
+    """Zero-based column of a cell reference such as AB1"""
+    position = 0
+    for letter in re.match(r'[A-Z]+', reference).group():
+        position = position * 26 + ord(letter) - ord('A') + 1
+    return position - 1
+
+
+def _read_xlsx_header(filepath) -> list:
+    """First row of the first sheet of a workbook, parsed straight from its
+    XML up to the end of that row. Unlike opening the workbook with
+    openpyxl, this does not read the whole shared string table, only the
+    strings up to the last one the header uses.
+    """
+    with zipfile.ZipFile(filepath) as archive:
+        cells = {}
+        with archive.open(_first_sheet_path(archive)) as sheet:
+            for _, element in ElementTree.iterparse(sheet):
+                if element.tag == f'{XLSX_NAMESPACE}c':
+                    if element.get('t') == 'inlineStr':
+                        value = ''.join(element.itertext())
+                    else:
+                        value = element.findtext(f'{XLSX_NAMESPACE}v')
+                    if value is not None:
+                        cells[_column_position(element.get('r'))] = (element.get('t'), value)
+                elif element.tag == f'{XLSX_NAMESPACE}row':
+                    break
+
+        shared = [int(value) for kind, value in cells.values() if kind == 's']
+        strings = []
+        if shared:
+            with archive.open('xl/sharedStrings.xml') as table:
+                for _, element in ElementTree.iterparse(table):
+                    if element.tag == f'{XLSX_NAMESPACE}si':
+                        strings.append(''.join(element.itertext()))
+                        element.clear()
+                        if len(strings) > max(shared):
+                            break
+
+    row = [None] * (max(cells) + 1 if cells else 0)
+    for position, (kind, value) in cells.items():
+        row[position] = strings[int(value)] if kind == 's' else value
+    return _excel_header(row)
+
+
+def read_header(filepath) -> list:
+    """Column names of an export, read from at most the first HEADER_BYTES
+    of a tab-separated file, or the first row of a spreadsheet, so the cost
+    does not depend on the size of the file. Names are returned as pandas
+    reads them. File-like objects are read from their start and returned to
+    their position.
     """
-    df = pd.read_csv(
+    is_path = isinstance(filepath, (str, os.PathLike))
+    position = None if is_path else filepath.tell()
+    try:
+        if is_excel_file(filepath):
+            return _read_xlsx_header(filepath)
+
+        if is_path:
+            with open(filepath, 'rb') as f:
+                head = f.read(HEADER_BYTES)
+        else:
+            filepath.seek(0)
+            head = filepath.read(HEADER_BYTES)
+    finally:
+        if position is not None:
+            filepath.seek(position)
+
+    if isinstance(head, bytes):
+        head = head.decode('utf-8', errors='replace')
+    line = head.lstrip('\ufeff').splitlines()[0] if head.strip() else ''
+    return next(csv.reader([line], delimiter='\t'), [])
+
+
+def normalize_column_name(name) -> str:
+    """Normalizes a column name for matching: case-insensitive, with
+    surrounding and repeated whitespace removed
+    """
+    return ' '.join(str(name).split()).casefold()
+
+
+def resolve_columns(header, columns, optional=None) -> dict:
+    """Maps the names in a file's header to the names the columns are
+    loaded as, for the columns of a schema (a dict of loaded names keyed by
+    export name) and those of the `optional` ones the header has. Raises
+    ValueError if the header lacks any of the required `columns`.
+    """
+    header_names = {normalize_column_name(name) for name in header}
+    missing = [name for name in columns if normalize_column_name(name) not in header_names]
+    if missing:
+        raise ValueError(
+            f'The file is missing the columns {missing}; is the distributor right?'
+        )
+    loaded_names = {
+        normalize_column_name(name): loaded for name, loaded in {**(optional or {}), **columns}.items()
+    }
+    # in the order of the file, as pandas reads them
+    return {
+        name: loaded_names[normalize_column_name(name)] for name in header
+        if normalize_column_name(name) in loaded_names
+    }
+
+
+def empty_categorical(length) -> pd.Categorical:
+    """Categorical column of `length` missing values"""
+    return pd.Categorical.from_codes(np.full(length, -1), categories=pd.Index([], dtype=object))
+
+
+def _read_export(
+        filepath, columns, chunksize, formatter, parse_dates=(), categorical=(), optional=None
+    ):
+    """Reads the columns of a tab-separated or spreadsheet export given by
+    `columns`, a dict of loaded names keyed by export name, and applies
+    `formatter` to the whole frame or, with `chunksize`, to each chunk of
+    an iterator of chunks.
+
+    Columns are selected by name, matched against the file's header. The
+    `optional` columns (a dict like `columns`) are read if the file has
+    them, and are otherwise loaded as empty categoricals. The `parse_dates`
+    columns are parsed as dates, and the `categorical` columns are read as
+    categoricals (both by loaded name).
+    """
+    selected = resolve_columns(read_header(filepath), columns, optional)
+    absent = [name for name in (optional or {}).values() if name not in selected.values()]
+
+    def add_absent(df):
+        for name in absent:
+            df[name] = empty_categorical(len(df))
+        return df
+
+    if is_excel_file(filepath):
+        def format_chunk(chunk):
+            chunk = chunk.rename(columns=selected)
+            for name in parse_dates:
+                chunk[name] = pd.to_datetime(chunk[name])
+            for name in categorical:
+                if name in chunk.columns:
+                    chunk[name] = chunk[name].astype('category')
+            return formatter(add_absent(chunk))
+
+        chunks = read_excel_chunks(filepath, list(selected), chunksize=chunksize or EXCEL_BATCH_ROWS)
+        if chunksize:
+            return (format_chunk(chunk) for chunk in chunks)
+        return format_chunk(pd.concat(chunks, ignore_index=True))
+
+    def format_frame(df):
+        return formatter(add_absent(df.rename(columns=selected)))
+
+    reader = pd.read_csv(
         filepath,
         delimiter='\t',
-        parse_dates=[0],
-        usecols=[1, 2, 7, 12]
+        parse_dates=[name for name, loaded in selected.items() if loaded in parse_dates],
+        usecols=list(selected),
+        dtype={name: 'category' for name, loaded in selected.items() if loaded in categorical},
+        chunksize=chunksize
     )
-    df.columns = ['Sales Date', 'Company Name Source', 'Quantity', 'Subtotal']
+    if chunksize:
+        return _iter_chunks(reader, format_frame)
+    return format_frame(reader)
+
+
+# Columns read from each export, keyed by their name in the export, and the
+# dimension columns read as well unless a loader is called with
+# `dimensions=False`
+CD_BABY_COLUMNS = {
+    'Report Date': 'Report Date',
+    'Sales Date': 'Sales Date',
+    'Quantity': 'Quantity',
+    'Subtotal': 'Subtotal',
+    'Partner Name': 'Company Name Source',
+    'Transaction Type': 'Transaction Type',
+}
+CD_BABY_DIMENSION_COLUMNS = {
+    'Isrc': 'ISRC',
+    'Album Name': 'Album',
+    'Track Name': 'Track',
+    'Delivery Country': 'Country',
+}
+
+DISTROKID_COLUMNS = {
+    'Reporting Date': 'Report Date',
+    'Sale Month': 'Sales Date',
+    'Store': 'Company Name Source',
+    'Quantity': 'Quantity',
+    'Earnings (USD)': 'Subtotal',
+}
+DISTROKID_DIMENSION_COLUMNS = {'Title': 'Track', 'ISRC': 'ISRC', 'Country of Sale': 'Country'}
+
+
+def _format_cd_baby(df) -> pd.DataFrame:
+    df['Transaction Type'] = df['Transaction Type'].str.replace(' ', '_').str.lower()
+    return df
 
+
+def load_cd_baby(filepath, chunksize=None, dimensions=True):
+    """Loader for a data file exported from CD Baby, tab-separated or as
+    a spreadsheet
+
+    If `chunksize` is set, an iterator of formatted chunks of at most
+    `chunksize` rows is returned instead of a single dataframe. If
+    `dimensions` is set, the ISRC, album, track and country columns are
+    kept, as categoricals, and are empty if the file lacks them.
+    """
+    return _read_export(
+        filepath, CD_BABY_COLUMNS, chunksize, _format_cd_baby,
+        categorical=CD_BABY_DIMENSION_COLUMNS.values() if dimensions else (),
+        optional=CD_BABY_DIMENSION_COLUMNS if dimensions else None
+    )
+
+
+def _format_distrokid(df) -> pd.DataFrame:
     # TODO: this is a kludgy attempt to guess transaction type since DistroKid 
     # doesn't provide this level of detail
-    df['Transaction Type'] = df['Subtotal'].apply(
-        lambda v: 'download' if v > 0.2 else 'stream')
+    df['Transaction Type'] = 'stream'
+    df.loc[df['Subtotal'] > 0.2, 'Transaction Type'] = 'download'
+
+    # DistroKid exports do not name the album of a track
+    if 'Track' in df.columns:
+        df['Album'] = empty_categorical(len(df))
 
     return df
 
 
+def load_distrokid(filepath, chunksize=None, dimensions=True):
+    """Loader for a data file exported from DistroKid, tab-separated or as
+    a spreadsheet
 
-def load_earnings_report(filepath, distributor, service_map_file) -> pd.DataFrame:
-    """Reads earnings report and transforms data, formatting dates,
-    and joining streaming company names to use
+    If `chunksize` is set, an iterator of formatted chunks of at most
+    `chunksize` rows is returned instead of a single dataframe. If
+    `dimensions` is set, the ISRC, track and country columns are kept, as
+    categoricals that are empty if the file lacks them, with an empty album
+    column.
+    """
+    return _read_export(
+        filepath, DISTROKID_COLUMNS, chunksize, _format_distrokid, parse_dates=['Report Date'],
+        categorical=DISTROKID_DIMENSION_COLUMNS.values() if dimensions else (),
+        optional=DISTROKID_DIMENSION_COLUMNS if dimensions else None
+    )
+
+
+distributor_loaders = {
+    'cd_baby': load_cd_baby,
+    'distrokid': load_distrokid
+}
+
+# Columns each distributor's exports must have, used to detect the format
+distributor_schemas = {
+    'cd_baby': (CD_BABY_COLUMNS, CD_BABY_DIMENSION_COLUMNS),
+    'distrokid': (DISTROKID_COLUMNS, DISTROKID_DIMENSION_COLUMNS),
+}
+
+# Distributor value that detects the format from the file's header
+AUTO_DETECT = 'auto'
+
+
+def detect_distributor(filepath) -> str:
+    """Detects the distributor of an export from its header: the schema
+    whose required columns are all present, preferring the one matching
+    the most columns. Raises ValueError if none matches.
     """
+    header = {normalize_column_name(name) for name in read_header(filepath)}
+    matches = {}
+    for distributor, (required, optional) in distributor_schemas.items():
+        names = {normalize_column_name(name) for name in required}
+        if names <= header:
+            optional_names = {normalize_column_name(name) for name in optional}
+            matches[distributor] = len(names) + len(optional_names & header)
+    if not matches:
+        name = getattr(filepath, 'name', filepath)
+        raise ValueError(f'Could not detect the distributor of "{name}" from its header')
+    return max(matches, key=matches.get)
 
-    distributor_loaders = {
-        'cd_baby': load_cd_baby,
-        'distrokid': load_distrokid
+
+def normalize_partner_name(name) -> str:
+    """Normalizes a partner name for lookups: case-insensitive, with
+    surrounding and repeated whitespace removed
+    """
+    return ' '.join(str(name).split()).casefold()
+
+
+@functools.lru_cache(maxsize=8)
+def _read_partner_index(service_map_file, _modified) -> dict:
+    service_map = pd.read_csv(service_map_file)
+    return {
+        normalize_partner_name(source): name for source, name in
+        zip(service_map['Company Name Source'], service_map['Company Name'])
     }
 
+
+def load_partner_index(service_map_file) -> dict:
+    """Returns company names keyed by normalized source name for a service
+    map file. Each file is read once per process, and again only if it
+    changes on disk.
+    """
+    path = os.fspath(service_map_file)
+    return _read_partner_index(path, os.stat(path).st_mtime_ns)
+
+
+def map_partner_names(sources: pd.Series, partner_index: dict) -> pd.Categorical:
+    """Maps source partner names to company names, as a categorical.
+
+    Each distinct source name is looked up once and the categorical codes are
+    translated in a single vectorized step. Names missing from the index map
+    to UNKNOWN_PARTNER.
+    """
+    sources = sources.astype('category')
+    names = [
+        partner_index.get(normalize_partner_name(source), UNKNOWN_PARTNER)
+        for source in sources.cat.categories
+    ]
+    categories, lookup = np.unique(names + [UNKNOWN_PARTNER], return_inverse=True)
+    codes = sources.cat.codes.to_numpy()
+    # missing source names (code -1) pick up the UNKNOWN_PARTNER entry at the end
+    return pd.Categorical.from_codes(lookup[codes], categories=categories)
+
+
+def unmapped_partner_summary(data) -> pd.Series:
+    """Row counts per source partner name that is not in the service map,
+    most frequent first
+    """
+    unmapped = data.loc[data['Company Name'] == UNKNOWN_PARTNER, 'Company Name Source']
+    counts = unmapped.value_counts(dropna=False)
+    return counts[counts > 0]
+
+
+def map_earnings_data(data, partner_index) -> pd.DataFrame:
+    """Adds date parts to loaded earnings data and maps the streaming
+    company names to use
+    """
+    sales_date = pd.to_datetime(data['Sales Date'])
+    data['Year'] = sales_date.dt.year
+    data['Month'] = sales_date.dt.month
+    data['Company Name'] = map_partner_names(data['Company Name Source'], partner_index)
+    return data
+
+
+def optimize_dtypes(data) -> pd.DataFrame:
+    """Converts loaded earnings data to compact dtypes: categoricals for
+    low-cardinality strings, the smallest integer types for Year, Month and
+    Quantity, and float32 subtotals when no value changes by more than
+    FLOAT32_TOLERANCE. Logs the memory saved.
+    """
+    before = data.memory_usage(deep=True).sum()
+
+    for column in CATEGORICAL_COLUMNS:
+        if column in data.columns:
+            data[column] = data[column].astype('category')
+    data['Year'] = data['Year'].astype('int16')
+    data['Month'] = data['Month'].astype('int8')
+    if data['Quantity'].notna().all():
+        data['Quantity'] = pd.to_numeric(data['Quantity'], downcast='integer')
+
+    subtotal = data['Subtotal'].to_numpy(dtype=float)
+    subtotal_32 = subtotal.astype(np.float32)
+    if np.nanmax(np.abs(subtotal - subtotal_32), initial=0) <= FLOAT32_TOLERANCE:
+        data['Subtotal'] = subtotal_32
+
+    after = data.memory_usage(deep=True).sum()
+    logger.info(
+        'Optimized dtypes: %.1f MB -> %.1f MB (saved %.1f MB)',
+        before / 1e6, after / 1e6, (before - after) / 1e6
+    )
+    return data
+
+
+def aggregate_earnings_chunks(chunks, partner_index, sketch=None) -> pd.DataFrame:
+    """Folds an iterator of loaded chunks into quantity and subtotal sums
+    per company, year, month and transaction type.
+
+    Only one chunk and the running totals are held in memory at a time,
+    so peak memory depends on the chunk size and the number of groups
+    rather than on the size of the file. If a `RateSketch` is given, the
+    rates of each chunk are added to it in the same pass.
+    """
+    totals = None
+    for i, chunk in enumerate(chunks):
+        logger.debug('Aggregating chunk %s (%s rows)', i, len(chunk))
+        chunk = map_earnings_data(chunk, partner_index)
+        if sketch is not None:
+            sketch.update(chunk)
+        partial = chunk.groupby(REPORT_AGGREGATE_KEYS, sort=False, observed=True)[REPORT_AGGREGATE_VALUES].sum()
+        totals = partial if totals is None else totals.add(partial, fill_value=0)
+
+    if totals is None:
+        return pd.DataFrame(columns=REPORT_AGGREGATE_KEYS + REPORT_AGGREGATE_VALUES)
+    return totals.sort_index().reset_index()
+
+
+def load_earnings_report(
+        filepath,
+        distributor,
+        service_map_file,
+        chunksize=None,
+        optimize_memory=False,
+        sketch=None
+    ) -> pd.DataFrame:
+    """Reads earnings report and transforms data, formatting dates,
+    and joining streaming company names to use
+
+    `distributor` may be AUTO_DETECT to pick the loader from the header of
+    the file with `detect_distributor`.
+
+    If `chunksize` is set, the file is streamed in chunks of that many rows
+    and the result is pre-aggregated by company, year, month and transaction
+    type. The aggregated frame can be passed to `generate_reports` in place
+    of the row-level data.
+
+    If `optimize_memory` is set, row-level data is converted to compact
+    dtypes with `optimize_dtypes`.
+
+    If a `RateSketch` is given, the rate of every transaction is added to
+    it, which is the only way to get rate quantiles of chunked loads.
+    """
+    if distributor in (None, AUTO_DETECT):
+        distributor = detect_distributor(filepath)
+        logger.info('Detected distributor "%s" from the file header', distributor)
+    distributor = getattr(distributor, 'value', distributor)
     logger.info('Loading data using distibutor "%s"', distributor)
-    data = distributor_loaders.get(distributor)(filepath)
+    loader = distributor_loaders.get(distributor)
+    if loader is None:
+        raise ValueError(f'Unknown distributor: {distributor}')
 
     logger.info('Using service map file: "%s"', service_map_file)
-    service_map = pd.read_csv(service_map_file)
-    data['Year'] = pd.DatetimeIndex(data['Sales Date']).year
-    data['Month'] = pd.DatetimeIndex(data['Sales Date']).month
-    data = data.merge(service_map, how='left')
-    data['Company Name'] = data['Company Name'].fillna('Unknown')
+    partner_index = load_partner_index(service_map_file)
+
+    if chunksize:
+        logger.info('Streaming data in chunks of %s rows', chunksize)
+        with instrumentation.stage('load') as timer:
+            data = aggregate_earnings_chunks(
+                loader(filepath, chunksize=chunksize, dimensions=False), partner_index, sketch
+            )
+            timer.add_rows(len(data))
+        return data
+
+    with instrumentation.stage('load') as timer:
+        data = loader(filepath)
+        timer.add_rows(len(data))
+    with instrumentation.stage('map', rows=len(data)):
+        data = map_earnings_data(data, partner_index)
+    if sketch is not None:
+        sketch.update(data)
+    unmapped = unmapped_partner_summary(data)
+    if not unmapped.empty:
+        logger.info('%s rows from %s partners are not in the service map', unmapped.sum(), len(unmapped))
+    if optimize_memory:
+        data = optimize_dtypes(data)
+    return data
+
+
+def resolve_input_paths(pattern) -> list:
+    """Expands a file path, a directory or a glob pattern into a sorted list
+    of earnings report files. Directories are searched for files ending in
+    one of EARNINGS_REPORT_SUFFIXES.
+    """
+    path = Path(pattern)
+    if path.is_dir():
+        paths = [p for p in path.iterdir() if p.suffix.lower() in EARNINGS_REPORT_SUFFIXES]
+    elif path.is_file():
+        paths = [path]
+    else:
+        paths = [Path(p) for p in glob.glob(str(pattern), recursive=True)]
+    return sorted(p for p in paths if p.is_file())
+
+
+def row_keys(data) -> np.ndarray:
+    """Identity of each row of loaded earnings data: a hash of the values
+    read from the export (not the MAPPED_COLUMNS) and of the number of
+    identical rows before it. Rows repeated within one export keep
+    distinct keys, while the same rows in another export, such as a
+    re-import or an overlapping download, get the same keys even if the
+    service map changed in between.
+    """
+    exported = data.drop(columns=[c for c in MAPPED_COLUMNS if c in data.columns])
+    hashes = pd.util.hash_pandas_object(exported, index=False).to_numpy()
+    occurrence = pd.Series(hashes).groupby(hashes).cumcount().to_numpy()
+    keyed = pd.DataFrame({'row': hashes, 'occurrence': occurrence})
+    return pd.util.hash_pandas_object(keyed, index=False).to_numpy()
+
+
+def combine_earnings_reports(reports) -> pd.DataFrame:
+    """Concatenates loaded earnings reports, dropping the rows (identified
+    by `row_keys`) that an earlier report already contains, so re-imported
+    or overlapping exports are not double counted. Exports that only share
+    report dates, such as one per artist, are kept whole.
+    """
+    seen = np.array([], dtype=np.uint64)
+    frames = []
+    for data in reports:
+        keys = row_keys(data)
+        is_new = ~np.isin(keys, seen)
+        frames.append(data[is_new])
+        seen = np.union1d(seen, keys[is_new])
+    return pd.concat(frames, ignore_index=True)
+
+
+def load_earnings_reports(
+        filepaths,
+        distributor,
+        service_map_file,
+        max_workers=None,
+        optimize_memory=False
+    ) -> pd.DataFrame:
+    """Loads several earnings reports with `load_earnings_report` and
+    combines them with `combine_earnings_reports`.
+
+    Files are parsed concurrently in a process pool, one file per worker.
+    Files are combined in the given order, so rows found in more than one
+    file are kept from the earliest.
+    """
+    filepaths = list(filepaths)
+    load = functools.partial(
+        load_earnings_report,
+        distributor=distributor,
+        service_map_file=service_map_file
+    )
+    if len(filepaths) == 1:
+        reports = [load(filepaths[0])]
+    else:
+        workers = min(max_workers or os.cpu_count() or 1, len(filepaths))
+        logger.info('Loading %s files with %s workers', len(filepaths), workers)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            reports = list(pool.map(load, filepaths))
+
+    data = combine_earnings_reports(reports)
+    if optimize_memory:
+        data = optimize_dtypes(data)
     return data
@@ -1,24 +1,47 @@
 from dataclasses import dataclass, field
 from datetime import date
+import functools
+import logging
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 
+import cpi_prefetch
 from data_loader import load_earnings_report
 import enums
-from inflation import adjust_amount, get_cpi_data
+import instrumentation
+from incremental import IncrementalReportStore, splice_report
 from logger import logger
-from utils import normalize_dataframe_values, to_date
+from quantile_sketch import RateSketch, quantile_name
+from utils import normalize_dataframe_values
+
+
+REPORT_ATTRIBUTES = {
+    'counts': 'count_report',
+    'rates': 'rate_report',
+    'earnings': 'earnings_report',
+    'cpi_adjusted_rates': 'rate_report_cpi_adj',
+    'cpi_adjusted_earnings': 'earnings_report_cpi_adj',
+}
 
 
 @dataclass
 class DistributorReport():
     """Container for all distributor reports
+
+    If `store_path` is set, the export is merged into an incremental store
+    of partial sums at that path, and reports are generated from the store.
+    Later exports can then be added with `update`.
     """
     filepath: Path
     distributor: enums.Distributor = enums.Distributor.CD_BABY
     filters: tuple[enums.Transaction] = field(default_factory=[enums.Transaction.STREAM])
+    chunksize: int | None = None
+    store_path: Path | None = None
+    granularity: enums.Granularity = enums.Granularity.YEAR
     source_data: pd.DataFrame = field(init=False)
+    store: IncrementalReportStore | None = field(init=False, default=None)
 
     # Derived reports
     count_report: pd.DataFrame = field(init=False)
@@ -28,86 +51,311 @@ class DistributorReport():
     earnings_report_cpi_adj: pd.DataFrame = field(init=False)
 
     def __post_init__(self):
+        if self.store_path:
+            self.store = IncrementalReportStore(self.store_path)
+            self.store.ingest(self._load(self.filepath))
+            self.store.save()
+            self.source_data = self.store.partial_sums
+        else:
+            self.source_data = self._load(self.filepath, chunksize=self.chunksize)
+
+        reports = generate_reports(
+            self.source_data,
+            transactions=self.filters,
+            adjust_for_inflation=True,
+            granularity=self.granularity
+        )
+        for name, attribute in REPORT_ATTRIBUTES.items():
+            setattr(self, attribute, reports[name])
+
+    def _load(self, filepath, chunksize=None) -> pd.DataFrame:
         service_map_file = Path('data/partner_map_simplified.csv')
-        self.source_data = load_earnings_report(
-            self.filepath,
+        return load_earnings_report(
+            filepath,
             self.distributor,
-            service_map_file=service_map_file
+            service_map_file=service_map_file,
+            chunksize=chunksize
         )
+
+    def update(self, filepath) -> set:
+        """Merges a new export into the incremental store and recomputes
+        only the report columns in the years it changed.
+        Returns the set of updated years.
+        """
+        if self.store is None:
+            raise ValueError('Incremental updates require a store_path')
+
+        years = self.store.ingest(self._load(filepath))
+        self.store.save()
+        self.source_data = self.store.partial_sums
+        if not years:
+            return years
+
+        logger.info('Updating reports for years: %s', sorted(years))
         reports = generate_reports(
-            self.source_data,
+            self.source_data[self.source_data['Year'].isin(years)],
             transactions=self.filters,
-            adjust_for_inflation=True
+            adjust_for_inflation=True,
+            granularity=self.granularity
         )
-        self.count_report = reports['counts']
-        self.rate_report = reports['rates']
-        self.earnings_report = reports['earnings']
-        self.rate_report_cpi_adj = reports['cpi_adjusted_rates']
-        self.earnings_report_cpi_adj = reports['cpi_adjusted_earnings']
+        for name, attribute in REPORT_ATTRIBUTES.items():
+            setattr(self, attribute, splice_report(getattr(self, attribute), reports[name]))
+        return years
+
+
+PERIOD_COLUMN_NAMES = {
+    enums.Granularity.YEAR: 'Year',
+    enums.Granularity.QUARTER: 'Quarter',
+    enums.Granularity.MONTH: 'Month',
+}
+
+
+def period_labels(data, granularity=enums.Granularity.YEAR):
+    """Labels each row with its report period: the year as an integer, or
+    a quarterly or monthly pandas Period, as a categorical.
+
+    Periods are built once per distinct year and month, and the row labels
+    are set with a vectorized code lookup.
+    """
+    granularity = enums.Granularity(granularity)
+    if granularity == enums.Granularity.YEAR:
+        return data['Year']
+
+    year = data['Year'].to_numpy(dtype=float)
+    month = data['Month'].to_numpy(dtype=float)
+    valid = ~(np.isnan(year) | np.isnan(month))
+    if granularity == enums.Granularity.QUARTER:
+        freq = 'Q'
+        keys = year * 4 + (month - 1) // 3
+        make_period = lambda k: pd.Period(year=int(k // 4), quarter=int(k % 4) + 1, freq=freq)
+    else:
+        freq = 'M'
+        keys = year * 12 + month - 1
+        make_period = lambda k: pd.Period(year=int(k // 12), month=int(k % 12) + 1, freq=freq)
+
+    unique_keys, codes = np.unique(keys[valid], return_inverse=True)
+    all_codes = np.full(len(keys), -1)
+    all_codes[valid] = codes
+    categories = pd.PeriodIndex([make_period(k) for k in unique_keys], freq=freq)
+    return pd.Series(
+        pd.Categorical.from_codes(all_codes, categories=categories),
+        index=data.index,
+        name=PERIOD_COLUMN_NAMES[granularity]
+    )
+
+
+def period_years(columns) -> np.ndarray:
+    """Calendar year of each report column"""
+    if isinstance(columns, pd.PeriodIndex):
+        return np.asarray(columns.year)
+    return np.asarray(columns, dtype=int)
 
 
 def adjust_report_for_inflation(report: pd.DataFrame, target_date: date):
     """
-    Iterate over all columns (years) and adjusts the amount to the target year value
+    Adjusts the amounts in every column (year, quarter or month) to the
+    target date value, using the average CPI over the months of each column.
+
+    One CPI factor is computed per column and applied to the whole report
+    with a single broadcast multiply.
     """
-    df = report.copy()
-    years = report.columns
-    cpi_data = get_cpi_data(years.min(), date.today().year)
-    for year in years:
-        from_date = to_date(f'{year}-06-30')
-        df[year] = df[year].apply(
-            lambda amt:
-                amt if pd.isnull(amt)
-                else adjust_amount(cpi_data, amt, from_date, target_date)
-        )
-    return df
+    if report.empty:
+        return report.copy()
+    with instrumentation.stage('cpi_adjust', rows=len(report)):
+        return _adjust_report_for_inflation(report, target_date)
+
 
+def _adjust_report_for_inflation(report, target_date):
+    columns = report.columns
+    years = period_years(columns)
+    cpi_index = cpi_prefetch.get_index(
+        min(years.min(), target_date.year),
+        max(years.max(), target_date.year)
+    )
+
+    if isinstance(columns, pd.PeriodIndex):
+        start = columns.asfreq('M', how='start')
+        n_months = 3 if columns.freqstr.startswith('Q') else 1
+        from_cpi = cpi_index.average(start.year, start.month, n_months)
+    else:
+        from_cpi = cpi_index.average(years, np.ones(len(years), dtype=int), 12)
+
+    to_cpi = cpi_index.lookup(target_date.year, target_date.month)
+    if to_cpi is None:
+        to_cpi = _latest_cpi(cpi_index, target_date)
+    factors = to_cpi / from_cpi
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            'CPI factors to %s (CPI %s): %s',
+            target_date, to_cpi, dict(zip(columns.astype(str), factors.round(4)))
+        )
+    return pd.DataFrame(
+        report.to_numpy(dtype=float) * factors,
+        index=report.index,
+        columns=report.columns
+    )
 
-def generate_reports(data, transactions=('stream'), adjust_for_inflation=True):
-    """Aggregate all-time data by counts, earnings, and rates
 
-    TODO: separate reports into different functions
+def _latest_cpi(cpi_index, target_date) -> float:
+    """CPI of the last published month, for target dates past the end of
+    the CPI data (e.g. offline, with only the bundled snapshot). Raises
+    ValueError if the index has no CPI value at or before the target date.
     """
-    if transactions:
-        # filter transactions
-        tr = [t.lower() for t in transactions]
-        data = data[data['Transaction Type'].str.lower().isin(tr)]
-
-    # create dataframes
-    earnings = data.pivot_table(
-        values='Subtotal',
-        index='Company Name',
-        columns='Year',
-        aggfunc='sum'
+    last_month = cpi_index.last_month
+    if last_month is None or (target_date.year, target_date.month) < last_month:
+        raise ValueError(f'No CPI data found for {target_date:%Y-%m}')
+    _warn_cpi_target_clamped(f'{target_date:%Y-%m}', last_month)
+    return cpi_index.lookup(*last_month)
+
+
+@functools.lru_cache(maxsize=None)
+def _warn_cpi_target_clamped(target_month, last_month) -> None:
+    """Logs once per target month that the latest CPI is used instead"""
+    logger.warning(
+        'No CPI data for %s yet, adjusting to %s-%02d, the latest month available',
+        target_month, *last_month
     )
-    earnings = normalize_dataframe_values(earnings)
 
-    counts = data.pivot_table(
-        values='Quantity',
-        index='Company Name',
-        columns='Year',
-        aggfunc='sum'
+
+def _group_sums(data, keys) -> pd.DataFrame:
+    """Sums Subtotal and Quantity in a single pass over categorical keys,
+    returning an index of plain (non-categorical) levels
+    """
+    keys = [key.astype('category') for key in keys]
+    values = data[['Subtotal', 'Quantity']].astype(float, copy=False)
+    sums = values.groupby(keys, observed=True).sum()
+    sums.index = sums.index.set_levels(
+        [pd.Index(level.to_numpy(), name=level.name) for level in sums.index.levels]
     )
-    counts = normalize_dataframe_values(counts)
+    return sums
 
+
+def _reports_from_sums(sums) -> dict:
+    """Builds the counts, earnings and rates reports from sums indexed by
+    company and period
+    """
+    earnings = sums['Subtotal'].unstack(-1)
+    counts = sums['Quantity'].unstack(-1)
     rates = earnings / counts
-    rates = normalize_dataframe_values(rates)
 
     # structure reports in a dictionary
     reports = dict()
-    reports['counts'] = counts
-    reports['earnings'] = earnings
-    reports['rates'] = rates
+    reports['counts'] = normalize_dataframe_values(counts)
+    reports['earnings'] = normalize_dataframe_values(earnings)
+    reports['rates'] = normalize_dataframe_values(rates)
+    return reports
+
+
+def add_cpi_adjusted_reports(reports, target_date=None) -> dict:
+    """Adds inflation-adjusted rates and earnings reports to a dictionary
+    of reports, adjusted to `target_date` (default: today)
+    """
+    target_date = target_date or date.today()
+    logger.info('Adding CPI adjusted reports')
+    rates_adjusted = adjust_report_for_inflation(reports['rates'], target_date)
+    reports['cpi_adjusted_rates'] = normalize_dataframe_values(rates_adjusted)
+
+    earnings_adjusted = adjust_report_for_inflation(reports['earnings'], target_date)
+    reports['cpi_adjusted_earnings'] = normalize_dataframe_values(earnings_adjusted)
+    return reports
+
+
+def aggregate_by_transaction(data, granularity=enums.Granularity.YEAR) -> pd.DataFrame:
+    """Sums Subtotal and Quantity per company, period and transaction type.
+
+    The result is small, and reports for any set of transaction types can be
+    built from it with `generate_reports_from_aggregates` without going back
+    to the row-level data.
+    """
+    with instrumentation.stage('aggregate', rows=len(data)):
+        return _group_sums(data, [
+            data['Company Name'],
+            period_labels(data, granularity),
+            data['Transaction Type']
+        ])
+
+
+def generate_reports_from_aggregates(aggregates, transactions=('stream'), adjust_for_inflation=True):
+    """Same as `generate_reports`, from the output of `aggregate_by_transaction`"""
+    if transactions:
+        with instrumentation.stage('filter', rows=len(aggregates)):
+            tr = [t.lower() for t in transactions]
+            types = aggregates.index.get_level_values('Transaction Type')
+            aggregates = aggregates[types.str.lower().isin(tr)]
+
+    with instrumentation.stage('pivot', rows=len(aggregates)):
+        sums = aggregates.groupby(level=[0, 1]).sum()
+        reports = _reports_from_sums(sums)
+    if adjust_for_inflation:
+        add_cpi_adjusted_reports(reports)
+    return reports
+
+
+def rate_quantile_reports(
+        sketch: RateSketch,
+        quantiles=(0.1, 0.5, 0.9),
+        transactions=('stream'),
+        granularity=enums.Granularity.YEAR
+    ) -> dict:
+    """Reports of estimated rate quantiles per company and period from a
+    `RateSketch`, named by `quantile_name` (e.g. rates_p50)
+    """
+    counts = sketch.counts
+    index = counts.index
+    if transactions:
+        tr = [t.lower() for t in transactions]
+        counts = counts[index.get_level_values('Transaction Type').str.lower().isin(tr)]
+        index = counts.index
+
+    keys = pd.DataFrame({
+        'Year': index.get_level_values('Year'),
+        'Month': index.get_level_values('Month')
+    })
+    periods = period_labels(keys, granularity)
+    estimates = sketch.quantiles(
+        [pd.Series(index.get_level_values('Company Name'), name='Company Name'), periods],
+        quantiles,
+        counts=counts
+    )
+    return {
+        quantile_name(q): normalize_dataframe_values(estimates[q].unstack(-1))
+        for q in quantiles
+    }
+
+
+def generate_reports(
+        data,
+        transactions=('stream'),
+        adjust_for_inflation=True,
+        granularity=enums.Granularity.YEAR,
+        rate_quantiles=(),
+        sketch=None
+    ):
+    """Aggregate all-time data by counts, earnings, and rates, with one
+    column per year, quarter or month depending on `granularity`
+
+    If `rate_quantiles` are given, reports of those quantiles of the
+    per-transaction rates are added too (see `rate_quantile_reports`),
+    from `sketch` if given, otherwise from the rows of `data`.
+    """
+    if transactions:
+        # filter transactions
+        with instrumentation.stage('filter', rows=len(data)):
+            tr = [t.lower() for t in transactions]
+            types = data['Transaction Type'].astype('category')
+            data = data[types.isin([t for t in types.cat.categories if t.lower() in tr])]
+
+    with instrumentation.stage('pivot', rows=len(data)):
+        sums = _group_sums(data, [data['Company Name'], period_labels(data, granularity)])
+        reports = _reports_from_sums(sums)
+
+    if rate_quantiles:
+        with instrumentation.stage('quantiles', rows=len(data)):
+            sketch = sketch or RateSketch().update(data)
+            reports.update(rate_quantile_reports(sketch, rate_quantiles, transactions, granularity))
 
     # append inflation-adjusted reports
     if adjust_for_inflation:
-        logger.info('Adding CPI adjusted reports')
-        rates_adjusted = adjust_report_for_inflation(reports['rates'], date.today())
-        rates_adjusted = normalize_dataframe_values(rates_adjusted)
-        reports['cpi_adjusted_rates'] = rates_adjusted
-
-        earnings_adjusted = adjust_report_for_inflation(reports['earnings'], date.today())
-        earnings_adjusted = normalize_dataframe_values(earnings_adjusted)
-        reports['cpi_adjusted_earnings'] = earnings_adjusted
+        add_cpi_adjusted_reports(reports)
 
     return reports
@@ -11,3 +11,9 @@ class Transaction(Enum):
     DOWNLOAD = 'download'
     ROYALTY = 'royalty'
     YOUTUBE_AUDIO = 'youtube_audio_tier'
+
+class Granularity(Enum):
+    """Supported report time granularities"""
+    YEAR = 'year'
+    QUARTER = 'quarter'
+    MONTH = 'month'
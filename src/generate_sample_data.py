@@ -1,9 +1,10 @@
-from datetime import date, timedelta
+from datetime import date
+import json
 import logging
 from pathlib import Path
-from random import choice, randrange
 
-from numpy import random as npr
+import click
+import numpy as np
 import pandas as pd
 
 logging.basicConfig(level=logging.INFO)
@@ -83,72 +84,224 @@ albums = {
     }
 }
 
-def get_available_album(year):
-    released = [album for album, metadata in albums.items() if metadata['Release Year'] <= year]
-    if not released:
-        return None
-    return choice(released)
-
-
-def generate_stream(date):
-    streaming_service = choice(streaming_services)
-    noise = npr.normal(0, 0.03)
-    amt = abs(rate_function_lookup.get(streaming_service)(date.year) + noise)
-    qty = randrange(2) + 1
-    album = get_available_album(date.year)
-    track = choice(albums[album]['Tracklist'])
-    transaction_type = choice(transaction_types_available[streaming_service])
-    country = choice(countries)
+# artist name -> album name -> release year and tracklist
+default_catalog = {artist_name: albums}
+
+CD_BABY_COLUMNS = [
+    'Report Date', 'Sales Date', 'Quantity', 'Price', 'Subtotal', 'Isrc',
+    'Barcode', 'CDBabySku', 'Album Name', 'Artist Name', 'Track Name',
+    'Partner Name', 'Transaction Type', 'Delivery Country'
+]
+
+DISTROKID_COLUMNS = [
+    'Reporting Date', 'Sale Month', 'Store', 'Artist', 'Title', 'ISRC', 'UPC',
+    'Quantity', 'Team Percentage', 'Song/Album', 'Country of Sale',
+    'Songwriter Royalties Withheld', 'Earnings (USD)'
+]
+
+
+def _choose_within(rng, offsets, counts):
+    """For each row, picks a random position within the slice of a flat
+    list that starts at `offsets` and holds `counts` items
+    """
+    return offsets + (rng.random(len(offsets)) * counts).astype(int)
+
+
+def _flatten_catalog(catalog):
+    """Lists the albums of a catalog, grouped by artist and ordered by
+    release year, with the tracks of all albums in one flat list
+    """
+    artists, album_names, release_years, tracks, track_counts = [], [], [], [], []
+    for artist, artist_albums in catalog.items():
+        for album in sorted(artist_albums, key=lambda a: artist_albums[a]['Release Year']):
+            artists.append(artist)
+            album_names.append(album)
+            release_years.append(artist_albums[album]['Release Year'])
+            tracks += artist_albums[album]['Tracklist']
+            track_counts.append(len(artist_albums[album]['Tracklist']))
+    track_counts = np.array(track_counts)
     return {
-        'Report Date': date + timedelta(days=24),
-        'Sales Date': date,
+        'artists': list(catalog),
+        'album_artists': np.array(artists, dtype=object),
+        'albums': np.array(album_names, dtype=object),
+        'release_years': np.array(release_years),
+        'tracks': np.array(tracks, dtype=object),
+        'track_counts': track_counts,
+        'track_offsets': np.cumsum(track_counts) - track_counts,
+    }
+
+
+def generate_sample_frame(
+        n_rows,
+        distributor='cd_baby',
+        rng=None,
+        start_date=date(2017, 1, 1),
+        end_date=date(2023, 12, 31),
+        catalog=None,
+        partner_weights=None
+    ) -> pd.DataFrame:
+    """Generates `n_rows` random transactions in the export format of a
+    distributor, drawing whole columns at once with NumPy.
+
+    `catalog` maps artist names to albums (see `default_catalog`). Artists are
+    equally likely, and each transaction is for an album the artist had
+    released by then (or their first album, if none was). `partner_weights`
+    maps streaming services to relative weights; by default all services
+    in `streaming_services` are equally likely.
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+    catalog = _flatten_catalog(catalog or default_catalog)
+    partner_weights = partner_weights or dict.fromkeys(streaming_services, 1)
+    services = list(partner_weights)
+    weights = np.array([partner_weights[s] for s in services], dtype=float)
+
+    days = pd.date_range(start_date, end_date, freq='D')
+    day = np.sort(rng.integers(0, len(days), n_rows))
+    years = days.year.to_numpy()[day]
+
+    service = rng.choice(len(services), size=n_rows, p=weights / weights.sum())
+    rates = np.zeros(n_rows)
+    for i, name in enumerate(services):
+        in_service = service == i
+        rates[in_service] = rate_function_lookup[name](years[in_service].astype(float))
+    amt = np.abs(rates + rng.normal(0, 0.03, n_rows))
+    qty = rng.integers(1, 3, n_rows)
+
+    artist = rng.integers(0, len(catalog['artists']), n_rows)
+    album = np.zeros(n_rows, dtype=int)
+    for i, name in enumerate(catalog['artists']):
+        by_artist = artist == i
+        first_album = np.argmax(catalog['album_artists'] == name)
+        release_years = catalog['release_years'][catalog['album_artists'] == name]
+        released = np.maximum(np.searchsorted(release_years, years[by_artist], side='right'), 1)
+        album[by_artist] = _choose_within(rng, np.full(by_artist.sum(), first_album), released)
+
+    track = _choose_within(rng, catalog['track_offsets'][album], catalog['track_counts'][album])
+
+    types = [t for s in services for t in transaction_types_available[s]]
+    type_counts = np.array([len(transaction_types_available[s]) for s in services])
+    type_offsets = np.cumsum(type_counts) - type_counts
+    transaction_type = _choose_within(rng, type_offsets[service], type_counts[service])
+
+    country = rng.integers(0, len(countries), n_rows)
+
+    # format each distinct day once rather than every row
+    report_dates = (days + pd.Timedelta(days=24)).strftime('%Y-%m-%d').to_numpy()[day]
+    subtotal = (amt * qty).round(3)
+    artist_column = catalog['album_artists'][album]
+    track_column = catalog['tracks'][track]
+    service_column = np.array(services, dtype=object)[service]
+    country_column = np.array(countries, dtype=object)[country]
+
+    if distributor == 'distrokid':
+        return pd.DataFrame({
+            'Reporting Date': report_dates,
+            'Sale Month': days.strftime('%Y-%m').to_numpy()[day],
+            'Store': service_column,
+            'Artist': artist_column,
+            'Title': track_column,
+            'ISRC': '-----',
+            'UPC': '-----',
+            'Quantity': qty,
+            'Team Percentage': 100,
+            'Song/Album': 'Song',
+            'Country of Sale': country_column,
+            'Songwriter Royalties Withheld': 0,
+            'Earnings (USD)': subtotal
+        }, columns=DISTROKID_COLUMNS)
+
+    return pd.DataFrame({
+        'Report Date': report_dates,
+        'Sales Date': days.strftime('%Y-%m-%d').to_numpy()[day],
         'Quantity': qty,
-        'Price': round(amt, 3),
-        'Subtotal': round(amt * qty, 3),
+        'Price': amt.round(3),
+        'Subtotal': subtotal,
         'Isrc': '-----',
         'Barcode': '-----',
         'CDBabySku': '-----',
-        'Album Name': album,
-        'Artist Name': artist_name,
-        'Track Name': track,
-        'Partner Name': streaming_service,
-        'Transaction Type': transaction_type,
-        'Delivery Country': country
-    }
+        'Album Name': catalog['albums'][album],
+        'Artist Name': artist_column,
+        'Track Name': track_column,
+        'Partner Name': service_column,
+        'Transaction Type': np.array(types, dtype=object)[transaction_type],
+        'Delivery Country': country_column
+    }, columns=CD_BABY_COLUMNS)
+
+
+def write_sample_data(path, n_rows, distributor='cd_baby', seed=None, chunk_rows=1_000_000, **options) -> None:
+    """Writes `n_rows` random transactions to a tab-separated file, generating
+    at most `chunk_rows` rows at a time. Other options are passed on to
+    `generate_sample_frame`. Output is reproducible for a given seed and
+    chunk size.
+    """
+    rng = np.random.default_rng(seed)
+    remaining = n_rows
+    header = True
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        while header or remaining > 0:
+            rows = min(chunk_rows, remaining)
+            frame = generate_sample_frame(rows, distributor, rng=rng, **options)
+            frame.to_csv(f, sep='\t', index=False, header=header)
+            header = False
+            remaining -= rows
+            logging.debug(f'{n_rows - remaining} of {n_rows} rows written')
 
-years = list(range(2017,2024))
-months = list(range(1,13))
-days = list(range(1,32))
 
-def main():
+def parse_partner_weights(ctx, param, values) -> dict:
+    """Parses repeated NAME=WEIGHT options into a dictionary"""
+    weights = {}
+    for value in values:
+        name, _, weight = value.rpartition('=')
+        if name not in rate_function_lookup:
+            raise click.BadParameter(f'Unknown partner "{name}", use one of: {", ".join(streaming_services)}')
+        try:
+            weights[name] = float(weight)
+        except ValueError as e:
+            raise click.BadParameter(f'Invalid weight in "{value}"') from e
+    return weights or None
+
+
+@click.command()
+@click.option('--rows', type=click.IntRange(min=0), default=25_000, show_default=True,
+              help='Number of transactions to generate')
+@click.option('--distributor', type=click.Choice(['cd_baby', 'distrokid']), default='cd_baby',
+              show_default=True, help='Export format to write')
+@click.option('--seed', type=int, default=None, help='Random seed, for reproducible output')
+@click.option('--start-date', type=click.DateTime(['%Y-%m-%d']), default='2017-01-01',
+              show_default=True, help='First sales date')
+@click.option('--end-date', type=click.DateTime(['%Y-%m-%d']), default='2023-12-31',
+              show_default=True, help='Last sales date')
+@click.option('--catalog', type=click.Path(exists=True, dir_okay=False), default=None,
+              help='JSON file mapping artists to albums, each with a "Release Year" and "Tracklist"')
+@click.option('--partner', 'partner_weights', multiple=True, callback=parse_partner_weights,
+              metavar='NAME=WEIGHT', help='Relative weight of a streaming service; repeat for each service')
+@click.option('--chunk-rows', type=click.IntRange(min=1), default=1_000_000, show_default=True,
+              help='Number of rows generated and written at a time')
+@click.option('--output', type=click.Path(dir_okay=False), default=None,
+              help='Output file (default: data/sample_data/sample_data_<distributor>.txt)')
+def main(rows, distributor, seed, start_date, end_date, catalog, partner_weights, chunk_rows, output):
+    """Generate a sample payout data file"""
     logging.info('Generating sample data...')
 
-    all_streams = []
-    for year in years:
-        logging.debug(f'generating streams for year {year}')
-        for month in months:
-            logging.debug(f'generating streams for month {month}')
-            for day in days:
-                logging.debug(f'generating streams for day {day}')
-                try:
-                    sale_date = date(year=year, month=month, day=day)
-                except ValueError: # invalid date
-                    pass
-                logging.debug(f'stream sale date: {sale_date}')
-                all_streams += [generate_stream(sale_date) for _i in range(randrange(20))]
-
-    data = pd.DataFrame(all_streams)
-    logging.info('Finished generating sample data.')
-    #print(data.head())
-
-    # save data
-    outfile_dir = Path('data/sample_data')
-    outfile_base = Path('sample_data_cd_baby.txt')
-    
-    logging.info(f'Saving data to file: {outfile_base}')
-    data.to_csv(outfile_dir / outfile_base, sep='\t', index=False)
+    if catalog:
+        with open(catalog, 'r', encoding='utf-8') as f:
+            catalog = json.load(f)
+
+    outfile = Path(output or f'data/sample_data/sample_data_{distributor}.txt')
+    logging.info(f'Saving data to file: {outfile}')
+    write_sample_data(
+        outfile,
+        rows,
+        distributor=distributor,
+        seed=seed,
+        chunk_rows=chunk_rows,
+        start_date=start_date.date(),
+        end_date=end_date.date(),
+        catalog=catalog,
+        partner_weights=partner_weights
+    )
 
     logging.info('Sample data saved successfully.')
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
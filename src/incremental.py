@@ -0,0 +1,143 @@
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from data_loader import REPORT_AGGREGATE_KEYS, REPORT_AGGREGATE_VALUES, row_keys
+from logger import logger
+
+
+PARTIAL_SUMS_COLUMNS = REPORT_AGGREGATE_KEYS + REPORT_AGGREGATE_VALUES
+
+# Partition of the rows without a readable report date
+UNKNOWN_REPORT_MONTH = 'unknown'
+
+
+def report_months(data) -> np.ndarray:
+    """Report month of each row of loaded earnings data, as YYYY-MM.
+    Each distinct report date is parsed once.
+    """
+    codes, dates = pd.factorize(data['Report Date'])
+    labels = pd.to_datetime(pd.Series(dates), errors='coerce').dt.strftime('%Y-%m')
+    labels = np.append(labels.fillna(UNKNOWN_REPORT_MONTH).to_numpy(dtype=object), UNKNOWN_REPORT_MONTH)
+    # missing dates (code -1) pick up the UNKNOWN_REPORT_MONTH entry at the end
+    return labels[codes]
+
+
+class IncrementalReportStore:
+    """Partial sums of quantity and subtotal per company, year, month and
+    transaction type, persisted to a directory with one partition per
+    report month. A partition holds the sums of the rows of that report
+    month and the keys (see `row_keys`) of those rows, in one file that is
+    replaced atomically, so its sums and keys are always saved together.
+
+    Merging a new export only reads and rewrites the partitions of the
+    report months it contains, and only aggregates its rows that are not in
+    them yet. Refreshing the store with a new month therefore costs time
+    proportional to that month rather than the whole history. Re-importing
+    an export, or one that overlaps earlier ones, adds nothing twice, while
+    exports that share a report date (e.g. one per artist) are all counted.
+    A store should hold the statements of a single distributor account.
+    """
+    PARTITION_SUFFIX = '.npz'
+
+    def __init__(self, path):
+        self.path = Path(path)
+        # sums of every partition, and the keys of the partitions read so far
+        self._sums = {}
+        self._keys = {}
+        self._changed = set()
+
+        for partition_file in sorted(self.path.glob(f'*{self.PARTITION_SUFFIX}')):
+            with np.load(partition_file) as partition:
+                self._sums[partition_file.stem] = pd.DataFrame(
+                    {column: partition[column] for column in PARTIAL_SUMS_COLUMNS}
+                )
+        if self._sums:
+            logger.info(
+                'Loaded incremental store with %s report months from "%s"',
+                len(self._sums), self.path
+            )
+
+    @property
+    def partial_sums(self) -> pd.DataFrame:
+        """Partial sums of all report months"""
+        sums = [s for s in self._sums.values() if not s.empty]
+        if not sums:
+            return pd.DataFrame(columns=PARTIAL_SUMS_COLUMNS)
+        totals = pd.concat(sums).groupby(REPORT_AGGREGATE_KEYS, observed=True)[REPORT_AGGREGATE_VALUES].sum()
+        return totals.reset_index()
+
+    def _partition_file(self, month) -> Path:
+        return self.path / f'{month}{self.PARTITION_SUFFIX}'
+
+    def _partition_keys(self, month) -> np.ndarray:
+        if month not in self._keys:
+            partition_file = self._partition_file(month)
+            if partition_file.exists():
+                with np.load(partition_file) as partition:
+                    self._keys[month] = partition['row_keys']
+            else:
+                self._keys[month] = np.array([], dtype=np.uint64)
+        return self._keys[month]
+
+    def ingest(self, data: pd.DataFrame) -> set:
+        """Merges the rows that are not yet in the store.
+        Returns the set of years whose sums changed.
+        """
+        keys = row_keys(data)
+        months = report_months(data)
+        is_new = np.zeros(len(data), dtype=bool)
+        for month in np.unique(months):
+            in_month = months == month
+            is_new[in_month] = ~np.isin(keys[in_month], self._partition_keys(month))
+
+        new_rows = data[is_new]
+        if new_rows.empty:
+            logger.info('No new rows to merge')
+            return set()
+
+        logger.info('Merging %s new rows of %s', len(new_rows), len(data))
+        new_months = pd.Series(months[is_new], index=new_rows.index, name='Report Month')
+        partial = new_rows.groupby(
+            [new_months] + [new_rows[key] for key in REPORT_AGGREGATE_KEYS], observed=True
+        )[REPORT_AGGREGATE_VALUES].sum()
+        for month, sums in partial.groupby(level='Report Month'):
+            sums = sums.droplevel('Report Month')
+            if month in self._sums:
+                sums = self._sums[month].set_index(REPORT_AGGREGATE_KEYS).add(sums, fill_value=0)
+            self._sums[month] = sums.sort_index().reset_index()
+            self._keys[month] = np.union1d(self._keys[month], keys[is_new & (months == month)])
+            self._changed.add(month)
+
+        return set(partial.index.get_level_values('Year').unique())
+
+    def save(self) -> None:
+        """Writes the partitions changed since the last save, replacing
+        each file atomically
+        """
+        self.path.mkdir(parents=True, exist_ok=True)
+        for month in sorted(self._changed):
+            sums = self._sums[month]
+            # names are saved as plain strings, so partitions load without pickle
+            arrays = {
+                column: sums[column].to_numpy(
+                    dtype=None if pd.api.types.is_numeric_dtype(sums[column]) else str
+                )
+                for column in PARTIAL_SUMS_COLUMNS
+            }
+            partition_file = self._partition_file(month)
+            tmp_file = partition_file.with_suffix('.tmp')
+            with open(tmp_file, "wb") as f:
+                np.savez(f, row_keys=self._keys[month], **arrays)
+            os.replace(tmp_file, partition_file)
+        self._changed.clear()
+
+
+def splice_report(report: pd.DataFrame, update: pd.DataFrame) -> pd.DataFrame:
+    """Replaces the columns of a report that an update contains, and adds
+    the update's new columns and rows
+    """
+    kept = report.drop(columns=[c for c in update.columns if c in report.columns])
+    return pd.concat([kept, update], axis=1).sort_index(axis=0).sort_index(axis=1)
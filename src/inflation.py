@@ -1,15 +1,26 @@
-from datetime import date
+import functools
 import json
 import os
-import requests
+from pathlib import Path
 
-from dotenv import load_dotenv
 import numpy as np
 
 from caching import disk_cache
 from logger import logger
 
-load_dotenv()
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+CPI_SNAPSHOT_FILE = PROJECT_ROOT / "data" / "cpi_snapshot.json"
+
+BLS_API_URL = 'https://api.bls.gov/publicAPI/v2/timeseries/data/'
+
+# The BLS v2 API serves at most 20 years per request for registered users
+# and 10 years without a registration key
+BLS_MAX_YEARS_PER_REQUEST = 20
+BLS_MAX_YEARS_PER_REQUEST_UNREGISTERED = 10
+
+# Years that BLS hasn't published all months for are re-requested after a day
+CPI_PARTIAL_YEAR_TTL = 24 * 60 * 60
 
 
 class APICallInvalidParameters(Exception):
@@ -25,23 +36,53 @@ class APICallError(Exception):
         super().__init__(self.message)
 
 
+@functools.lru_cache(maxsize=None)
+def load_environment() -> None:
+    """Loads variables from a .env file into the environment, once, the
+    first time a setting is needed rather than at import
+    """
+    from dotenv import load_dotenv
+    load_dotenv()
 
-@disk_cache
-def get_cpi_values_for_year(year: int, series='CUUR0000SA0') -> dict:
+
+def getenv(key, default=None):
+    """Reads a setting from the environment or the .env file"""
+    load_environment()
+    return os.getenv(key, default)
+
+
+def is_offline() -> bool:
     """
-    TODO: validate inputs and response data
+    True if the CPI_OFFLINE environment variable is set, in which case
+    CPI data is never requested over the network
+    """
+    return getenv('CPI_OFFLINE', '').lower() in ('1', 'true', 'yes')
+
+
+def request_cpi_values(
+        start_year: int,
+        end_year: int,
+        series='CUUR0000SA0',
+        session=None
+    ) -> list:
     """
+    Requests CPI values for a range of years in a single call to the BLS API.
+    The range must not exceed the number of years allowed per request.
+    """
+    import requests
+
+    http = session or requests
     headers = {'Content-type': 'application/json'}
     data = json.dumps(
         {
-            "registrationkey": os.getenv("BLS_API_KEY"),
+            "registrationkey": getenv("BLS_API_KEY"),
             "seriesid": [series],
-            "startyear": year,
-            "endyear": year,
+            "startyear": start_year,
+            "endyear": end_year,
         }
     )
-    response = requests.post(
-        url='https://api.bls.gov/publicAPI/v2/timeseries/data/',
+    response = http.post(
+        url=getenv('BLS_API_URL', BLS_API_URL),
         data=data,
         headers=headers,
         timeout=3.0
@@ -50,91 +91,220 @@ def get_cpi_values_for_year(year: int, series='CUUR0000SA0') -> dict:
 
     if response_json["status"] == 'REQUEST_FAILED_INVALID_PARAMETERS':
         logger.error(response_json['message'])
-        logger.error("Parameters: %s", f"{year=}, {series=}")
+        logger.error("Parameters: %s", f"{start_year=}, {end_year=}, {series=}")
         raise APICallInvalidParameters
 
     if response_json['status'] == 'REQUEST_NOT_PROCESSED':
         logger.error(response_json['message'])
         raise APICallError
 
-    cpi_values = response_json['Results']['series'][0]['data']
-    return cpi_values
+    return response_json['Results']['series'][0]['data']
 
 
-def restructure_cpi_dict(cpi_values: dict) -> dict:
+def cpi_cache_ttl(cpi_values: list):
     """
-    Restructure CPI dictionary so the years and months are 
-    keys rather than values in a list of dictionaries
+    Cache lifetime for a year of CPI values: complete years never expire,
+    partial years expire so newly published months are picked up
     """
-    years = list(set(i['year'] for i in cpi_values))
-    months = list(set(i['period'] for i in cpi_values))
-    years.sort()
-    months.sort()
-    cpi = {}
-    for yy in years:
-        y = int(yy)
-        cpi[y] = {}
-        for mm in months:
-            m = int(mm[1:])
-            values = [
-                d['value'] for d in cpi_values if
-                    (d['year'] == yy) and (d['period'] == mm)
-            ]
-            if values:
-                cpi[y][m] = float(values[0])
-    return cpi
+    months = {d['period'] for d in cpi_values if d['period'] != 'M13'}
+    return None if len(months) >= 12 else CPI_PARTIAL_YEAR_TTL
 
 
-def get_cpi_data(start_year: int, end_year: int, series='CUUR0000SA0') -> dict:
+@disk_cache(ttl=cpi_cache_ttl)
+def get_cpi_values_for_year(year: int, series='CUUR0000SA0') -> dict:
     """
     TODO: validate inputs and response data
     """
-    cpi_data = {}
-    for year in range(start_year, end_year + 1):
-        cpi_data_for_year = get_cpi_values_for_year(year, series=series)
-        formatted = restructure_cpi_dict(cpi_data_for_year)
-        cpi_data = cpi_data | formatted
-    return cpi_data
+    return request_cpi_values(year, year, series=series)
 
 
-def get_most_recent_cpi(cpi_data: dict, year: int, month: int) -> float:
+def group_cpi_values_by_year(cpi_values: list, years) -> dict:
     """
-    Look up the CPI value for a given year and month. If the CPI data
-    is not available, then the function will check to see if CPI data
-    is available for up to 3 months prior
+    Splits the data list of a BLS API response into one list per year.
+    Years without data are included with an empty list.
     """
+    grouped = {year: [] for year in years}
+    for d in cpi_values:
+        year = int(d['year'])
+        if year in grouped:
+            grouped[year].append(d)
+    return grouped
+
 
-    tries = 0
-    recent_cpi = None
-    while not recent_cpi and tries < 6:
-        logger.debug('Looking up CPI for date: %s', f'{year}-{month}')
+def fetch_cpi_values(years: list, series='CUUR0000SA0') -> dict:
+    """
+    Fetches CPI values for a list of years from the BLS API, requesting each
+    run of consecutive years in as few calls as the API allows, over a single
+    HTTP session. Returns a dictionary of data lists keyed by year.
+    """
+    batch_size = (
+        BLS_MAX_YEARS_PER_REQUEST if getenv("BLS_API_KEY")
+        else BLS_MAX_YEARS_PER_REQUEST_UNREGISTERED
+    )
+    batches = []
+    for year in sorted(set(years)):
+        if batches and year == batches[-1][1] + 1 and year - batches[-1][0] < batch_size:
+            batches[-1][1] = year
+        else:
+            batches.append([year, year])
+
+    import requests
+
+    cpi_values = []
+    with requests.Session() as session:
+        for batch_start, batch_end in batches:
+            logger.info('Requesting CPI data for %s-%s', batch_start, batch_end)
+            cpi_values += request_cpi_values(batch_start, batch_end, series, session)
+    return group_cpi_values_by_year(cpi_values, years)
+
+
+def load_cpi_snapshot(years: list, series='CUUR0000SA0') -> dict:
+    """
+    Reads CPI values bundled with the project, for use when the BLS API
+    can't be reached. Returns a dictionary of data lists keyed by year.
+    """
+    with open(CPI_SNAPSHOT_FILE, "r", encoding="utf-8") as f:
+        snapshot = json.load(f)
+    cpi_values = snapshot['data'] if snapshot['seriesID'] == series else []
+    return group_cpi_values_by_year(cpi_values, years)
+
+
+def get_cpi_values_for_years(start_year: int, end_year: int, series='CUUR0000SA0') -> dict:
+    """
+    Returns CPI data lists keyed by year for a range of years.
+
+    Years that are in the disk cache are read from it. The remaining years
+    are requested from the BLS API in batches and cached. If the API can't
+    be reached, or CPI_OFFLINE is set, the bundled CPI snapshot is used.
+    """
+    import requests
+
+    years = range(start_year, end_year + 1)
+    missing = [y for y in years if not get_cpi_values_for_year.is_cached(y, series=series)]
+
+    fetched = {}
+    if missing and not is_offline():
         try:
-            recent_cpi = cpi_data[year][month]
-        except KeyError:
-            if month == 1:
-                # go to Dec of previous year
-                year -= 1
-                month = 12
-            else:
-                # try previous month in year
-                month -= 1
-            tries += 1
-
-    return recent_cpi
-
-
-def adjust_amount(
-        cpi_data: dict,
-        amount: float,
-        from_date: date,
-        to_date: date
-    ) -> float:
-    """
-    Adjusts an amount using the Consumer Price Index across two dates
-    """
-    from_cpi = get_most_recent_cpi(cpi_data, from_date.year, from_date.month)
-    to_cpi = get_most_recent_cpi(cpi_data, to_date.year, to_date.month)
-
-    if not (from_cpi and to_cpi): # TODO: raise an exception here instead
-        return np.nan
-    return amount * (to_cpi / from_cpi)
+            fetched = fetch_cpi_values(missing, series)
+        except (
+            requests.RequestException, ValueError, KeyError, IndexError,
+            APICallError, APICallInvalidParameters
+        ) as e:
+            logger.warning('Could not fetch CPI data, using bundled snapshot: %s', e)
+        for year in missing:
+            if year in fetched:
+                get_cpi_values_for_year.store(fetched[year], year, series=series)
+    if missing and not fetched:
+        fetched = load_cpi_snapshot(missing, series)
+
+    return {
+        year: fetched[year] if year in fetched
+        else get_cpi_values_for_year(year, series=series)
+        for year in years
+    }
+
+
+class CPIIndex:
+    """
+    Dense monthly CPI values stored in an array indexed by the number of
+    months since January of `base_year`.
+
+    Gaps are forward-filled when the index is built, up to
+    MAX_LOOKBACK_MONTHS after the last known month, so single and vectorized
+    lookups are constant time. Months without CPI data hold NaN.
+    """
+    MAX_LOOKBACK_MONTHS = 5
+
+    def __init__(self, base_year: int, values: np.ndarray, last_position: int | None = None):
+        self.base_year = base_year
+        self.values = values
+        if last_position is None:
+            valid = np.flatnonzero(~np.isnan(values))
+            last_position = int(valid[-1]) if len(valid) else -1
+        # position of the last published month, before forward-filling
+        self.last_position = last_position
+
+    @classmethod
+    def from_cpi_values(cls, cpi_values: list) -> 'CPIIndex':
+        """Builds the index from the data list of a BLS API response"""
+        years, months, values = [], [], []
+        for d in cpi_values:
+            month = int(d['period'][1:])
+            if not 1 <= month <= 12:  # skip annual averages (M13)
+                continue
+            years.append(int(d['year']))
+            months.append(month)
+            values.append(float(d['value']))
+        if not values:
+            return cls(0, np.array([], dtype=float))
+
+        years = np.array(years)
+        base_year = int(years.min())
+        positions = (years - base_year) * 12 + np.array(months) - 1
+        # leave room past the last value for the look-back window
+        raw = np.full(positions.max() + 1 + cls.MAX_LOOKBACK_MONTHS, np.nan)
+        # assign in reverse so the first value listed for a month wins
+        raw[positions[::-1]] = np.array(values)[::-1]
+        filled = cls._forward_fill(raw, cls.MAX_LOOKBACK_MONTHS)
+        return cls(base_year, filled, last_position=int(positions.max()))
+
+    @staticmethod
+    def _forward_fill(raw: np.ndarray, limit: int) -> np.ndarray:
+        positions = np.arange(len(raw))
+        last_valid = np.maximum.accumulate(np.where(np.isnan(raw), -1, positions))
+        filled = raw[np.maximum(last_valid, 0)]
+        filled[(last_valid < 0) | (positions - last_valid > limit)] = np.nan
+        return filled
+
+    @property
+    def last_month(self) -> tuple | None:
+        """Year and month of the last published CPI value, or None if the
+        index is empty
+        """
+        if self.last_position < 0:
+            return None
+        return self.base_year + self.last_position // 12, self.last_position % 12 + 1
+
+    def lookup(self, year: int, month: int) -> float:
+        """
+        Look up the CPI value for a given year and month, falling back to
+        the most recent available month. Returns None if no value is found.
+        """
+        position = (year - self.base_year) * 12 + month - 1
+        if not 0 <= position < len(self.values) or np.isnan(self.values[position]):
+            return None
+        return float(self.values[position])
+
+    def lookup_many(self, years, months) -> np.ndarray:
+        """Vectorized `lookup`, returning NaN where no value is found"""
+        positions = (np.asarray(years) - self.base_year) * 12 + np.asarray(months) - 1
+        in_range = (positions >= 0) & (positions < len(self.values))
+        result = np.full(positions.shape, np.nan)
+        result[in_range] = self.values[positions[in_range]]
+        return result
+
+    def average(self, years, months, n_months: int) -> np.ndarray:
+        """
+        Vectorized average CPI over the `n_months` months starting at each
+        year and month, skipping months without a value. Returns NaN where
+        no month in the range has a value.
+        """
+        starts = (np.asarray(years) - self.base_year) * 12 + np.asarray(months) - 1
+        positions = starts[:, None] + np.arange(n_months)
+        values = self.lookup_many(
+            self.base_year + positions // 12,
+            positions % 12 + 1
+        )
+        found = ~np.isnan(values)
+        with np.errstate(invalid='ignore'):
+            return np.where(found, values, 0).sum(axis=1) / found.sum(axis=1)
+
+
+def get_cpi_index(start_year: int, end_year: int, series='CUUR0000SA0') -> CPIIndex:
+    """
+    Builds a `CPIIndex` covering the given range of years
+    """
+    cpi_values = []
+    for cpi_data_for_year in get_cpi_values_for_years(start_year, end_year, series).values():
+        cpi_values += cpi_data_for_year
+    return CPIIndex.from_cpi_values(cpi_values)
@@ -0,0 +1,125 @@
+from collections import OrderedDict
+import hashlib
+import os
+from pathlib import Path
+
+import pandas as pd
+
+from caching import CACHE_DIR
+from data_loader import CATEGORICAL_COLUMNS, load_earnings_report
+import instrumentation
+from logger import logger
+
+
+INGEST_CACHE_DIR = CACHE_DIR / "ingest"
+MAX_CACHED_REPORTS = 20
+
+# Content hashes remembered per file, so reruns don't re-read unchanged files
+MAX_REMEMBERED_HASHES = 64
+_content_hashes = OrderedDict()
+
+# Bump when the loaded frame changes shape, so stale entries are not reused
+INGEST_CACHE_VERSION = 4
+
+
+def _update_hash(digest, source, block_size=1 << 20):
+    """Feeds a file path or file-like object into a hash, block by block"""
+    if isinstance(source, (str, Path)):
+        with open(source, 'rb') as f:
+            while block := f.read(block_size):
+                digest.update(block)
+        return
+
+    position = source.tell()
+    source.seek(0)
+    while block := source.read(block_size):
+        digest.update(block)
+    source.seek(position)
+
+
+def _hash_key(source):
+    """Key under which the content hash of a file is remembered: its path,
+    size and modification time, or the id, name and size of an uploaded
+    file. None for file-like objects without an id, which are always hashed.
+    """
+    if isinstance(source, (str, Path)):
+        stat = os.stat(source)
+        return ('path', str(Path(source).resolve()), stat.st_size, stat.st_mtime_ns)
+    file_id = getattr(source, 'file_id', None)
+    if file_id is None:
+        return None
+    return ('upload', file_id, getattr(source, 'name', None), getattr(source, 'size', None))
+
+
+def content_hash(source) -> str:
+    """SHA-256 of a file path or file-like object, remembered per file"""
+    key = _hash_key(source)
+    if key in _content_hashes:
+        _content_hashes.move_to_end(key)
+        return _content_hashes[key]
+
+    digest = hashlib.sha256()
+    _update_hash(digest, source)
+    value = digest.hexdigest()
+    if key is not None:
+        _content_hashes[key] = value
+        while len(_content_hashes) > MAX_REMEMBERED_HASHES:
+            _content_hashes.popitem(last=False)
+    return value
+
+
+def fingerprint(source, distributor, service_map_file) -> str:
+    """Content hash of an earnings report file, the distributor and
+    the service map used to load it
+    """
+    parts = [INGEST_CACHE_VERSION, distributor, content_hash(service_map_file), content_hash(source)]
+    return hashlib.sha256(':'.join(map(str, parts)).encode('utf-8')).hexdigest()
+
+
+def _evict(cache_dir, max_entries):
+    """Removes all but the most recently used cached reports"""
+    entries = sorted(cache_dir.glob('*.parquet'), key=lambda p: p.stat().st_mtime, reverse=True)
+    for path in entries[max_entries:]:
+        path.unlink(missing_ok=True)
+
+
+def load_earnings_report_cached(
+        filepath,
+        distributor,
+        service_map_file,
+        key=None,
+        cache_dir=INGEST_CACHE_DIR,
+        max_entries=MAX_CACHED_REPORTS
+    ) -> pd.DataFrame:
+    """Loads an earnings report with compact dtypes, keeping a copy
+    of the loaded frame as a parquet file keyed by its content hash.
+
+    Loading the same file again memory-maps the parquet file instead of
+    parsing and mapping the export. The cache is kept in the project's local
+    cache directory and is never shared.
+    """
+    key = key or fingerprint(filepath, distributor, service_map_file)
+    cache_dir = Path(cache_dir)
+    path = cache_dir / f'{key}.parquet'
+    instrumentation.record_cache('ingest', path.exists())
+    if path.exists():
+        logger.info('Loading earnings report from ingest cache')
+        os.utime(path)
+        data = pd.read_parquet(path, engine='pyarrow', memory_map=True)
+        # parquet does not keep categoricals of dates, or with no categories
+        for column in CATEGORICAL_COLUMNS:
+            if column in data.columns and not isinstance(data[column].dtype, pd.CategoricalDtype):
+                data[column] = data[column].astype('category')
+        return data
+
+    data = load_earnings_report(
+        filepath, distributor, service_map_file, optimize_memory=True
+    )
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(f'.{os.getpid()}.tmp')
+    data.to_parquet(tmp_path, engine='pyarrow', index=False)
+    os.replace(tmp_path, path)
+    _evict(cache_dir, max_entries)
+    logger.info('Saved earnings report to ingest cache')
+    return data
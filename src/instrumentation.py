@@ -0,0 +1,210 @@
+from contextlib import contextmanager
+import json
+import os
+from pathlib import Path
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+# Set to 1 to collect metrics without calling `enable`
+METRICS_ENV_VAR = 'PIPELINE_METRICS'
+
+PROMETHEUS_PREFIX = 'soc'
+
+_lock = threading.Lock()
+_enabled = os.getenv(METRICS_ENV_VAR, '').lower() in ('1', 'true', 'yes')
+_stages = {}
+_cache_counters = {}
+
+
+def enable() -> None:
+    """Starts collecting metrics in this process"""
+    global _enabled
+    _enabled = True
+
+
+def disable() -> None:
+    """Stops collecting metrics, keeping those already collected"""
+    global _enabled
+    _enabled = False
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def reset() -> None:
+    """Discards all collected metrics"""
+    with _lock:
+        _stages.clear()
+        _cache_counters.clear()
+
+
+def peak_rss_mb() -> float | None:
+    """Peak resident set size of this process so far, in MB, or None where
+    the `resource` module is not available
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 1e6 if sys.platform == 'darwin' else peak / 1e3
+
+
+def _empty_stage() -> dict:
+    return {'calls': 0, 'seconds': 0.0, 'rows': 0, 'peak_rss_growth_mb': None}
+
+
+class StageTimer:
+    """Handle yielded by `stage`, used to report the rows a stage handled"""
+    __slots__ = ('rows',)
+
+    def __init__(self):
+        self.rows = 0
+
+    def add_rows(self, rows) -> None:
+        self.rows += int(rows)
+
+
+class _NullStageTimer:
+    __slots__ = ()
+
+    def add_rows(self, rows) -> None:
+        pass
+
+
+_NULL_STAGE_TIMER = _NullStageTimer()
+
+
+@contextmanager
+def stage(name, rows=None):
+    """Times a pipeline stage, adding to its call count, total seconds and
+    row count. Also keeps the most any one run of the stage raised the
+    process's peak RSS, which is 0 for stages that stay below a peak
+    reached earlier. Does nothing unless enabled.
+
+        with instrumentation.stage('load') as timer:
+            data = load(...)
+            timer.add_rows(len(data))
+    """
+    if not _enabled:
+        yield _NULL_STAGE_TIMER
+        return
+
+    timer = StageTimer()
+    if rows is not None:
+        timer.add_rows(rows)
+    start_peak = peak_rss_mb()
+    start = time.perf_counter()
+    try:
+        yield timer
+    finally:
+        elapsed = time.perf_counter() - start
+        peak = peak_rss_mb()
+        with _lock:
+            metrics = _stages.setdefault(name, _empty_stage())
+            metrics['calls'] += 1
+            metrics['seconds'] += elapsed
+            metrics['rows'] += timer.rows
+            if peak is not None:
+                growth = peak - start_peak
+                metrics['peak_rss_growth_mb'] = max(metrics['peak_rss_growth_mb'] or 0, growth)
+
+
+def record_cache(cache, hit) -> None:
+    """Counts a hit or a miss of the named cache. Does nothing unless enabled."""
+    if not _enabled:
+        return
+    with _lock:
+        counters = _cache_counters.setdefault(cache, {'hits': 0, 'misses': 0})
+        counters['hits' if hit else 'misses'] += 1
+
+
+def merge(metrics) -> None:
+    """Adds metrics collected in another process (a `snapshot`) to this
+    process's metrics
+    """
+    with _lock:
+        for name, other in metrics['stages'].items():
+            current = _stages.setdefault(name, _empty_stage())
+            for key in ('calls', 'seconds', 'rows'):
+                current[key] += other[key]
+            if other['peak_rss_growth_mb'] is not None:
+                current['peak_rss_growth_mb'] = max(
+                    current['peak_rss_growth_mb'] or 0, other['peak_rss_growth_mb']
+                )
+        for name, other in metrics['caches'].items():
+            current = _cache_counters.setdefault(name, {'hits': 0, 'misses': 0})
+            current['hits'] += other['hits']
+            current['misses'] += other['misses']
+
+
+def snapshot() -> dict:
+    """Copy of the metrics collected so far"""
+    with _lock:
+        return {
+            'stages': {name: dict(metrics) for name, metrics in _stages.items()},
+            'caches': {name: dict(counters) for name, counters in _cache_counters.items()},
+            'peak_rss_mb': peak_rss_mb()
+        }
+
+
+def to_json(metrics=None) -> str:
+    """Metrics as a JSON document"""
+    return json.dumps(metrics or snapshot(), indent=2)
+
+
+def _escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def to_prometheus(metrics=None) -> str:
+    """Metrics in the Prometheus text exposition format"""
+    metrics = metrics or snapshot()
+    p = PROMETHEUS_PREFIX
+    lines = []
+
+    def family(name, kind, help_text, samples):
+        lines.append(f'# HELP {p}_{name} {help_text}')
+        lines.append(f'# TYPE {p}_{name} {kind}')
+        for labels, value in samples:
+            label_text = ','.join(f'{k}="{_escape_label(v)}"' for k, v in labels.items())
+            lines.append(f'{p}_{name}{{{label_text}}} {value}' if labels else f'{p}_{name} {value}')
+
+    stages = metrics['stages']
+    family('stage_calls_total', 'counter', 'Number of times a pipeline stage ran',
+           [({'stage': s}, m['calls']) for s, m in stages.items()])
+    family('stage_seconds_total', 'counter', 'Total seconds spent in a pipeline stage',
+           [({'stage': s}, m['seconds']) for s, m in stages.items()])
+    family('stage_rows_total', 'counter', 'Total rows handled by a pipeline stage',
+           [({'stage': s}, m['rows']) for s, m in stages.items()])
+    family('stage_peak_rss_growth_megabytes', 'gauge',
+           'Most that one run of a pipeline stage raised the peak resident set size of the process',
+           [({'stage': s}, m['peak_rss_growth_mb'])
+            for s, m in stages.items() if m['peak_rss_growth_mb'] is not None])
+
+    caches = metrics['caches']
+    family('cache_hits_total', 'counter', 'Cache lookups that found an entry',
+           [({'cache': c}, n['hits']) for c, n in caches.items()])
+    family('cache_misses_total', 'counter', 'Cache lookups that did not find an entry',
+           [({'cache': c}, n['misses']) for c, n in caches.items()])
+
+    if metrics.get('peak_rss_mb') is not None:
+        family('peak_rss_megabytes', 'gauge', 'Peak resident set size of the process',
+               [({}, metrics['peak_rss_mb'])])
+    return '\n'.join(lines) + '\n'
+
+
+def write_metrics(path) -> None:
+    """Writes the metrics collected so far to a file, in Prometheus text
+    format if its suffix is .prom, and as JSON otherwise
+    """
+    path = Path(path)
+    text = to_prometheus() if path.suffix == '.prom' else to_json()
+    path.write_text(text, encoding='utf-8')
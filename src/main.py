@@ -1,11 +1,9 @@
 import click
 import logging
 from pathlib import Path
-from bokeh.plotting import show
 
-from data_processor import generate_reports, load_earnings_report
 import enums
-import plotting
+import instrumentation
 
 
 logging.basicConfig(
@@ -15,30 +13,78 @@ logging.basicConfig(
 
 allowed_distributors = [d.value for d in enums.Distributor]
 allowed_transactions = [t.value for t in enums.Transaction]
+allowed_granularities = [g.value for g in enums.Granularity]
 
 
 @click.command()
-@click.argument('file_name', type=click.Path(exists=True), nargs=1)
-@click.argument('distributor', type=click.Choice(allowed_distributors), default='cd_baby', nargs=1)
+@click.argument('file_name', nargs=1)
+@click.argument('distributor', type=click.Choice(allowed_distributors + ['auto']), default='auto', nargs=1)
 @click.argument('transactions', type=click.Choice(allowed_transactions), nargs=-1)
-def main(file_name, distributor, transactions) -> None:
-    
-    source_data_path = Path(file_name)
+@click.option('--chunksize', type=click.IntRange(min=1), default=None,
+              help='Stream the file in chunks of this many rows to bound memory use')
+@click.option('--workers', type=click.IntRange(min=1), default=None,
+              help='Number of processes used to load multiple files (default: one per core)')
+@click.option('--granularity', type=click.Choice(allowed_granularities), default='year',
+              show_default=True, help='Time period of each report column')
+@click.option('--metrics', type=click.Path(dir_okay=False), default=None,
+              help='Collect stage timings, row counts, memory and cache metrics and write them '
+                   'to this file (Prometheus text if it ends in .prom, JSON otherwise)')
+def main(file_name, distributor, transactions, chunksize, workers, granularity, metrics) -> None:
+    """Load FILE_NAME, which may be a file, a directory or a quoted glob
+    pattern, and plot transaction rates over time
+    """
+    # pandas and bokeh are imported here so `--help` and argument errors
+    # do not pay for them
+    from bokeh.plotting import show
+
+    import cpi_prefetch
+    from data_loader import load_earnings_report, load_earnings_reports, resolve_input_paths
+    from data_processor import generate_reports
+    import plotting
+
+    if metrics:
+        instrumentation.enable()
+
+    source_data_paths = resolve_input_paths(file_name)
     partner_map_path = Path('data/partner_map_simplified.csv')
-    
-    logging.info(f'Loading data from file: {source_data_path.name}...')
-    earnings_report = load_earnings_report(source_data_path, distributor, partner_map_path)
+    if not source_data_paths:
+        raise click.BadParameter(f'No files found for "{file_name}"', param_hint='FILE_NAME')
+    if chunksize and len(source_data_paths) > 1:
+        raise click.UsageError('--chunksize can only be used with a single file')
+
+    if len(source_data_paths) == 1:
+        # CPI values load in the background while the earnings data loads.
+        # Several files are loaded in forked processes, which must not be
+        # forked with the prefetch thread running, so they load first.
+        cpi_prefetch.start_prefetch()
+        logging.info(f'Loading data from file: {source_data_paths[0].name}...')
+        earnings_report = load_earnings_report(
+            source_data_paths[0], distributor, partner_map_path, chunksize=chunksize
+        )
+    else:
+        logging.info(f'Loading data from {len(source_data_paths)} files...')
+        earnings_report = load_earnings_reports(
+            source_data_paths, distributor, partner_map_path, max_workers=workers
+        )
+
+    cpi_prefetch.start_prefetch(earnings_report)
 
     # TODO: separate reports into different functions
     # TODO: move the reports into a dataclass
     logging.info('Generating summary reports...')
-    summary_reports = generate_reports(earnings_report, transactions, adjust_for_inflation=True)
+    summary_reports = generate_reports(
+        earnings_report, transactions, adjust_for_inflation=True, granularity=granularity
+    )
 
     logging.info('Generating interactive graph...')
     transactions_str = ', '.join(transactions).title() + ' Transactions - '
     plot_1 = plotting.generate_bokeh_plot(summary_reports['rates'], title_text=f'{transactions_str} Nominal')
     plot_2 = plotting.generate_bokeh_plot(summary_reports['cpi_adjusted_rates'], title_text=f'{transactions_str} Adjusted for inflation')
 
+    if metrics:
+        instrumentation.write_metrics(metrics)
+        logging.info(f'Metrics saved to {metrics}')
+
     show(plot_1)
     show(plot_2)
     
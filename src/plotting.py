@@ -1,50 +1,157 @@
+import functools
 from math import floor
-import bokeh
-from bokeh.plotting import figure, ColumnDataSource
-from bokeh.models import Legend, NumeralTickFormatter, Title, Range1d
+
+import numpy as np
 import pandas as pd
 
+import instrumentation
+
+
+PARTNER_DETAILS_FILE = 'data/partner_details.csv'
+
+OTHER_PARTNER = 'Other'
+DEFAULT_PARTNER_COLOR = '#DDDDDD'
 
-partner_details = pd.read_csv('data/partner_details.csv', index_col='Partner Name')
+# Bounds on the size of ECharts payloads
+DEFAULT_TOP_N = 10
+DEFAULT_MAX_POINTS = 240
 
 
+@functools.lru_cache(maxsize=None)
+def get_partner_details() -> pd.DataFrame:
+    """Reads the partner details file on first use"""
+    return pd.read_csv(PARTNER_DETAILS_FILE, index_col='Partner Name')
+
+
+@functools.lru_cache(maxsize=None)
+def get_partner_colors() -> dict:
+    """Graph color of each partner as a plain dict, built once from the
+    partner details file
+    """
+    details = get_partner_details()
+    return dict(zip(details.index, details['Graph Color']))
+
+
+def partner_colors(companies) -> list:
+    """Graph color of each partner, DEFAULT_PARTNER_COLOR if it has none"""
+    colors = get_partner_colors()
+    return [colors.get(company, DEFAULT_PARTNER_COLOR) for company in companies]
+
+
+def __getattr__(name):
+    # keep `plotting.partner_details` working without reading it at import
+    if name == 'partner_details':
+        return get_partner_details()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def report_column_positions(columns) -> np.ndarray:
+    """Positions of report columns on a numeric time axis: the year, plus
+    the fraction of the year before the start of quarterly or monthly periods
+    """
+    if isinstance(columns, pd.PeriodIndex):
+        start = columns.asfreq('M', how='start')
+        return np.asarray(start.year + (start.month - 1) / 12)
+    return np.asarray(columns)
+
+
+def report_axis_labels(columns, padding=2) -> list:
+    """Category axis labels for report columns, followed by `padding`
+    empty periods after the last one
+    """
+    last = columns.max()
+    return [str(c) for c in list(columns) + [last + i for i in range(1, padding + 1)]]
+
+
+@instrumentation.stage('plot')
 def generate_bokeh_plot(
             rates: pd.DataFrame,
             size=(1000, 500),
             title_text='Nominal rates (unadjusted)'
         ):
-    """generate a bokeh plot of transation rates over time
+    """generate a bokeh plot of transation rates over time, next to a
+    checkbox per partner to show or hide it.
+
+    All partners are drawn with a single multi-line glyph and a single
+    scatter glyph, each over one data source. Hidden partners are left out
+    by one filter per source, which the checkboxes update in the browser.
     """
-    years = rates.columns.values
-    companies = rates.index.values
-    palette = bokeh.palettes.all_palettes['Turbo'][256][32:]
-    skip = floor(len(palette) / len(companies))
-    colors = [palette[i*skip] for i in range(len(companies))]
-    
+    # bokeh is slow to import, so only load it when a plot is made
+    from bokeh.layouts import row
+    from bokeh.models import (
+        CDSView, CheckboxGroup, CustomJS, HoverTool, IndexFilter, Legend, LegendItem,
+        NumeralTickFormatter, Title, Range1d
+    )
+    from bokeh.palettes import all_palettes
+    from bokeh.plotting import figure, ColumnDataSource
+
+    years = report_column_positions(rates.columns)
+    periods = [str(c) for c in rates.columns]
+    companies = [str(c) for c in rates.index.values]
+    values = rates.to_numpy(dtype=float)
+    palette = all_palettes['Turbo'][256][32:]
+    skip = max(floor(len(palette) / max(len(companies), 1)), 1)
+    colors = [palette[(i * skip) % len(palette)] for i in range(len(companies))]
+
     TOOLS = 'pan,wheel_zoom,reset,save,box_select'
     TOOLTIPS = [('Company', '@Company'), 
-                ('Year', '@Year'),
+                ('Period', '@Period'),
                 ('Rate', '@Rate{$0.0000}')]
     p = figure(
             width=size[0], 
             height=size[1],
-            tools=TOOLS,
-            tooltips=TOOLTIPS
+            tools=TOOLS
         )
-    
-    legend_it = []
-    for i, company in enumerate(rates.index.values):
-        source = ColumnDataSource(
-            data = {
-                'Year': years,
-                'Rate': rates.iloc[i].values,
-                'Company': [company]*len(years)
-            }
-        )
-        c = p.circle('Year', 'Rate', source=source, color=colors[i], size=2)
-        l = p.line('Year', 'Rate', source=source, color=colors[i])
-        legend_it.append((company, [c, l]))
-    
+
+    # one source, glyph and filter for all partners, so the number of
+    # bokeh models does not grow with the number of partners
+    n_periods = len(years)
+    line_source = ColumnDataSource(data={
+        'xs': [years] * len(companies),
+        'ys': list(values),
+        'color': colors,
+        'Company': companies
+    })
+    point_source = ColumnDataSource(data={
+        'Year': np.tile(years, len(companies)),
+        'Period': periods * len(companies),
+        'Rate': values.ravel(),
+        'Company': np.repeat(companies, n_periods),
+        'color': np.repeat(colors, n_periods)
+    })
+    line_filter = IndexFilter(list(range(len(companies))))
+    point_filter = IndexFilter(list(range(len(companies) * n_periods)))
+    lines = p.multi_line(
+        'xs', 'ys', line_color='color', source=line_source,
+        view=CDSView(source=line_source, filters=[line_filter])
+    )
+    points = p.scatter(
+        'Year', 'Rate', color='color', size=2, source=point_source,
+        view=CDSView(source=point_source, filters=[point_filter])
+    )
+    p.add_tools(HoverTool(tooltips=TOOLTIPS, renderers=[points]))
+    legend_it = [
+        LegendItem(label=company, renderers=[lines], index=i)
+        for i, company in enumerate(companies)
+    ]
+
+    checkboxes = CheckboxGroup(labels=companies, active=list(range(len(companies))))
+    checkboxes.js_on_change('active', CustomJS(
+        args=dict(
+            line_filter=line_filter, point_filter=point_filter,
+            line_source=line_source, point_source=point_source, n_periods=n_periods
+        ),
+        code="""
+            const shown = [...cb_obj.active].sort((a, b) => a - b)
+            line_filter.indices = shown
+            point_filter.indices = shown.flatMap(
+                (i) => Array.from({length: n_periods}, (_, j) => i * n_periods + j)
+            )
+            line_source.change.emit()
+            point_source.change.emit()
+        """
+    ))
+
     p.add_layout(
         Title(
             text='Single artist report - do not use for general market trends'.upper(), 
@@ -71,48 +178,151 @@ def generate_bokeh_plot(
     p.y_range = Range1d(0, 0.04, bounds=(0, .2))
     p.yaxis[0].formatter = NumeralTickFormatter(format='$ 0.000')
 
-    legend = Legend(items=legend_it, click_policy='hide')
+    legend = Legend(items=legend_it)
     p.add_layout(legend, 'right')
 
     # TODO: figure out how to make the wheel zoom default scroll
     # p.toolbar.active_inspect = [pan, wheel_zoom]
     
-    return p
+    return row(p, checkboxes)
+
+
+
+def lttb_indices(y, n_out) -> np.ndarray:
+    """Indices of the points kept by Largest-Triangle-Three-Buckets
+    downsampling of `y` (evenly spaced) to `n_out` points. The first and
+    last points are always kept; each bucket in between keeps the point
+    forming the largest triangle with the previously kept point and the
+    mean of the next bucket.
+    """
+    n = len(y)
+    if n_out >= n:
+        return np.arange(n)
+    if n_out < 3:
+        return np.array([0, n - 1])[:n_out]
+
+    x = np.arange(n, dtype=float)
+    y = np.nan_to_num(np.asarray(y, dtype=float))
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    kept = np.empty(n_out, dtype=int)
+    kept[0], kept[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        next_lo, next_hi = hi, edges[i + 2] if i + 2 < len(edges) else n
+        next_x = x[next_lo:next_hi].mean()
+        next_y = y[next_lo:next_hi].mean()
+        area = np.abs(
+            (x[a] - next_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (next_y - y[a])
+        )
+        a = kept[i + 1] = lo + int(np.argmax(area))
+    return kept
+
+
+def top_partners(
+            report: pd.DataFrame,
+            top_n=DEFAULT_TOP_N,
+            rollup='sum',
+            weights: pd.DataFrame | None = None
+        ) -> pd.DataFrame:
+    """Keeps the `top_n` partners of a report and rolls the rest up into a
+    single OTHER_PARTNER row.
+
+    Partners are ranked by the total of `weights` (e.g. transaction counts)
+    if given, otherwise by the total of the report's own values. The rest
+    are summed with `rollup='sum'` (earnings, counts) or averaged with
+    `rollup='mean'` (rates), weighted by `weights` if given. A partner already
+    named OTHER_PARTNER is always part of the rollup.
+    """
+    if rollup not in ('sum', 'mean'):
+        raise ValueError(f'Unknown rollup: {rollup}')
+    values = report.to_numpy(dtype=float)
+    if weights is not None:
+        weights = weights.reindex(index=report.index, columns=report.columns).to_numpy(dtype=float)
+    score = np.nansum(np.abs(values if weights is None else weights), axis=1)
 
+    candidates = report.index != OTHER_PARTNER
+    if candidates.sum() <= top_n:
+        return report
+    ranked = np.argsort(-np.where(candidates, score, -np.inf), kind='stable')
+    keep = np.zeros(len(report), dtype=bool)
+    keep[ranked[:top_n]] = True
 
+    rest = values[~keep]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if rollup == 'sum':
+            other = np.where(np.isnan(rest).all(axis=0), np.nan, np.nansum(rest, axis=0))
+        elif weights is None:
+            other = np.nanmean(rest, axis=0) if np.isfinite(rest).any() else np.full(rest.shape[1], np.nan)
+        else:
+            rest_weights = np.where(np.isnan(rest), 0, np.nan_to_num(weights[~keep]))
+            other = np.nansum(rest * rest_weights, axis=0) / rest_weights.sum(axis=0)
+            other[~np.isfinite(other)] = np.nan
 
+    other_row = pd.DataFrame([other], index=[OTHER_PARTNER], columns=report.columns)
+    other_row.index.name = report.index.name
+    return pd.concat([report[keep], other_row])
+
+
+def downsample_columns(report: pd.DataFrame, max_points=DEFAULT_MAX_POINTS) -> pd.DataFrame:
+    """Keeps at most `max_points` columns of a report, chosen with LTTB
+    over the mean of the partners' series, each scaled to its own maximum,
+    so every series shares the same x axis
+    """
+    if len(report.columns) <= max_points:
+        return report
+    values = np.abs(report.to_numpy(dtype=float))
+    peaks = np.nan_to_num(values).max(axis=1, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        scaled = values / peaks
+    scaled[~np.isfinite(scaled)] = np.nan
+    counts = (~np.isnan(scaled)).sum(axis=0)
+    signal = np.nansum(scaled, axis=0) / np.maximum(counts, 1)
+    return report.iloc[:, lttb_indices(signal, max_points)]
+
+
+def series_values(report: pd.DataFrame, precision=4) -> list:
+    """Rows of a report as lists of rounded floats, with None for missing
+    values, ready to be serialized as JSON
+    """
+    values = np.round(report.to_numpy(dtype=float), precision).astype(object)
+    values[pd.isnull(values)] = None
+    return values.tolist()
+
+
+@instrumentation.stage('plot')
 def generate_echarts_rates_plot_options(
             rates: pd.DataFrame,
-            title_text='Nominal rates (unadjusted)'
+            title_text='Nominal rates (unadjusted)',
+            top_n=DEFAULT_TOP_N,
+            max_points=DEFAULT_MAX_POINTS,
+            rollup='mean',
+            weights: pd.DataFrame | None = None
         ):
+    """Options for an ECharts line plot of a report, one series per partner.
 
-    years = [str(y) for y  in rates.columns.values] + \
-        [str(max(rates.columns.values)+1), str(max(rates.columns.values)+2)]
-    companies = [str(c) for c in rates.index.values]
-    
-    def convert_rate(value, precision=4):
-        if pd.isnull(value): return None
-        return round(value, precision)
+    The payload is bounded to `top_n` partners plus an "Other" rollup (see
+    `top_partners`) and `max_points` periods (see `downsample_columns`).
+    Use `rollup='sum'` for earnings and counts.
+    """
+    rates = top_partners(rates, top_n=top_n, rollup=rollup, weights=weights)
+    rates = downsample_columns(rates, max_points=max_points)
 
-    tiers_map = partner_details[['Tier']].squeeze()
+    years = report_axis_labels(rates.columns)
+    companies = [str(c) for c in rates.index.values]
 
-    series = []
-    for i, company in enumerate(companies):
-        values = [convert_rate(v) for v in rates.iloc[i].values]
-        series.append({
+    series = [
+        {
             'name': company,
             'type': 'line',
             'symbol': 'circle',
             'symbolSize': 4,
             'data': values
-        })
-
-    #palette = bokeh.palettes.all_palettes['Turbo'][256][32:]
-    #skip = floor(len(palette) / len(companies))
-    #colors = [palette[i*skip] for i in range(len(companies))]
+        }
+        for company, values in zip(companies, series_values(rates))
+    ]
 
-    colors_map = partner_details[['Graph Color']].squeeze()
-    colors = [colors_map.get(company, '#DDDDDD') for company in companies]
+    colors = partner_colors(companies)
 
 
     options = {
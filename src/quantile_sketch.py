@@ -0,0 +1,129 @@
+import numpy as np
+import pandas as pd
+
+from data_loader import REPORT_AGGREGATE_KEYS
+
+
+SKETCH_KEYS = REPORT_AGGREGATE_KEYS + ['Bucket']
+
+# Quantiles are estimated within this relative error
+DEFAULT_RELATIVE_ACCURACY = 0.01
+
+# Bucket of rates of zero or less (free or refunded transactions)
+ZERO_BUCKET = np.iinfo(np.int32).min
+
+# Rates below this are counted in the zero bucket
+MIN_RATE = 1e-9
+
+
+class RateSketch:
+    """Mergeable histograms of per-transaction rates (subtotal per unit)
+    per company, year, month and transaction type.
+
+    Rates are counted in logarithmic buckets, so any quantile is estimated
+    within `relative_accuracy` of the true value, as in DDSketch. Each
+    transaction is weighted by its quantity, so quantiles are per unit
+    (e.g. per stream). The size of a sketch depends on the number of groups
+    and the spread of rates, not on the number of rows, so sketches can be
+    built chunk by chunk and merged across files.
+    """
+
+    def __init__(self, relative_accuracy=DEFAULT_RELATIVE_ACCURACY, counts: pd.Series | None = None):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = np.log(self.gamma)
+        if counts is None:
+            index = pd.MultiIndex.from_arrays([[]] * len(SKETCH_KEYS), names=SKETCH_KEYS)
+            counts = pd.Series([], index=index, dtype=float, name='Weight')
+        self.counts = counts
+
+    def __len__(self) -> int:
+        return len(self.counts)
+
+    def bucket_of(self, rates) -> np.ndarray:
+        """Bucket index of each rate"""
+        rates = np.asarray(rates, dtype=float)
+        buckets = np.full(len(rates), ZERO_BUCKET, dtype=np.int32)
+        positive = rates >= MIN_RATE
+        buckets[positive] = np.ceil(np.log(rates[positive]) / self._log_gamma)
+        return buckets
+
+    def bucket_value(self, buckets) -> np.ndarray:
+        """Rate represented by each bucket: within `relative_accuracy` of
+        every rate in the bucket
+        """
+        buckets = np.asarray(buckets)
+        values = 2 * self.gamma ** buckets.astype(float) / (self.gamma + 1)
+        return np.where(buckets == ZERO_BUCKET, 0.0, values)
+
+    def update(self, data: pd.DataFrame) -> 'RateSketch':
+        """Adds the transactions of loaded earnings data (or of one chunk
+        of it) to the sketch. Rows without a positive quantity or without a
+        subtotal are skipped.
+        """
+        quantity = data['Quantity'].to_numpy(dtype=float)
+        subtotal = data['Subtotal'].to_numpy(dtype=float)
+        valid = (quantity > 0) & ~np.isnan(subtotal)
+        if not valid.any():
+            return self
+        rates = subtotal[valid] / quantity[valid]
+
+        keys = [data[key][valid].astype('category') for key in REPORT_AGGREGATE_KEYS]
+        buckets = pd.Series(self.bucket_of(rates), index=keys[0].index, name='Bucket')
+        weights = pd.Series(quantity[valid], index=keys[0].index, name='Weight')
+        partial = weights.groupby(keys + [buckets], observed=True).sum()
+        partial.index = pd.MultiIndex.from_arrays(
+            [partial.index.get_level_values(i).to_numpy() for i in range(partial.index.nlevels)],
+            names=SKETCH_KEYS
+        )
+        self.counts = partial if self.counts.empty else self.counts.add(partial, fill_value=0)
+        return self
+
+    def merge(self, other: 'RateSketch') -> 'RateSketch':
+        """Combines two sketches, e.g. of different chunks or files, into a
+        new one
+        """
+        if not np.isclose(self.relative_accuracy, other.relative_accuracy):
+            raise ValueError('Only sketches with the same relative accuracy can be merged')
+        if self.counts.empty or other.counts.empty:
+            counts = other.counts if self.counts.empty else self.counts
+        else:
+            counts = self.counts.add(other.counts, fill_value=0)
+        return RateSketch(self.relative_accuracy, counts.copy())
+
+    def quantiles(self, keys, quantiles=(0.1, 0.5, 0.9), counts: pd.Series | None = None) -> pd.DataFrame:
+        """Estimated quantiles of the rates in each group of `keys`, a list
+        of arrays aligned with the rows of `counts` (default: all counts).
+        Returns one column per quantile, indexed by group.
+        """
+        counts = self.counts if counts is None else counts
+        names = [getattr(key, 'name', None) or f'key_{i}' for i, key in enumerate(keys)]
+        frame = pd.DataFrame({name: np.asarray(key) for name, key in zip(names, keys)})
+        frame['Bucket'] = counts.index.get_level_values('Bucket').to_numpy()
+        frame['Weight'] = counts.to_numpy()
+        key_columns = list(frame.columns[:-2])
+
+        # merge the histograms of each group, sorted by bucket
+        histogram = frame.groupby(key_columns + ['Bucket'], observed=True, sort=True)['Weight'].sum()
+        if histogram.empty:
+            return pd.DataFrame(columns=list(quantiles), dtype=float)
+        group_levels = list(range(len(key_columns)))
+        cumulative = histogram.groupby(level=group_levels, observed=True).cumsum().to_numpy()
+        totals = histogram.groupby(level=group_levels, observed=True).transform('sum').to_numpy()
+        group_ids = histogram.index.droplevel('Bucket')
+        bucket_values = self.bucket_value(histogram.index.get_level_values('Bucket').to_numpy())
+
+        starts = np.flatnonzero(np.r_[True, group_ids[1:] != group_ids[:-1]])
+        ends = np.r_[starts[1:], len(histogram)]
+        result = {}
+        for q in quantiles:
+            reached = cumulative >= q * totals
+            # first bucket of each group whose cumulative weight reaches q
+            first = np.minimum.reduceat(np.where(reached, np.arange(len(reached)), len(reached)), starts)
+            result[q] = bucket_values[np.minimum(first, ends - 1)]
+        return pd.DataFrame(result, index=group_ids[starts])
+
+
+def quantile_name(q) -> str:
+    """Report name of a rate quantile, e.g. rates_p50 for 0.5"""
+    return f'rates_p{q * 100:g}'
@@ -0,0 +1,82 @@
+from collections import OrderedDict
+from datetime import date
+
+from data_processor import (
+    add_cpi_adjusted_reports,
+    aggregate_by_transaction,
+    generate_reports_from_aggregates,
+)
+import enums
+import instrumentation
+from logger import logger
+
+
+DEFAULT_MAX_ENTRIES = 16
+
+
+class ReportCache:
+    """Memoizes reports for a dataset, keyed by the dataset's fingerprint,
+    the transaction types and the report options.
+
+    The per-transaction aggregates of a dataset are computed once per
+    granularity. Changing the transaction types then only recombines those
+    small aggregates, and inflation-adjusted reports are only computed when
+    they are asked for. Each kind of entry is evicted least recently used
+    first, beyond `max_entries`.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._aggregates = OrderedDict()
+        self._reports = OrderedDict()
+
+    def _get(self, entries, key, compute):
+        instrumentation.record_cache('report', key in entries)
+        if key in entries:
+            entries.move_to_end(key)
+            return entries[key]
+        value = entries[key] = compute()
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+        return value
+
+    def get_reports(
+            self,
+            fingerprint,
+            data,
+            transactions,
+            adjust_for_inflation=True,
+            granularity=enums.Granularity.YEAR
+        ) -> dict:
+        """Returns the same reports as `generate_reports` for `data`, whose
+        content is identified by `fingerprint`
+        """
+        granularity = enums.Granularity(granularity)
+        transactions = tuple(sorted({t.lower() for t in transactions}))
+
+        def aggregate():
+            logger.info('Aggregating transactions by %s', granularity.value)
+            return aggregate_by_transaction(data, granularity)
+
+        aggregates = self._get(self._aggregates, (fingerprint, granularity), aggregate)
+        nominal = self._get(
+            self._reports,
+            (fingerprint, granularity, transactions, None),
+            lambda: generate_reports_from_aggregates(
+                aggregates, transactions, adjust_for_inflation=False
+            )
+        )
+        if not adjust_for_inflation:
+            return dict(nominal)
+
+        # keyed by date, since reports are adjusted to today's value
+        return self._get(
+            self._reports,
+            (fingerprint, granularity, transactions, date.today()),
+            lambda: add_cpi_adjusted_reports(dict(nominal))
+        )
+
+    def clear(self) -> None:
+        """Removes all cached aggregates and reports"""
+        self._aggregates.clear()
+        self._reports.clear()
@@ -0,0 +1,104 @@
+import numpy as np
+import pandas as pd
+
+from data_loader import DIMENSION_COLUMNS, REPORT_AGGREGATE_VALUES
+import instrumentation
+from logger import logger
+
+
+CUBE_DIMENSIONS = ['Company Name', 'Year', 'Month', 'Transaction Type'] + DIMENSION_COLUMNS
+
+# Grain levels precomputed besides the finest one, from coarse to fine
+DEFAULT_GRAINS = [
+    ('Company Name', 'Year', 'Transaction Type'),
+    ('Company Name', 'Year', 'Month', 'Transaction Type'),
+    ('Company Name', 'Year', 'Transaction Type', 'Country'),
+    ('Company Name', 'Year', 'Transaction Type', 'Album', 'Track'),
+    ('Company Name', 'Year', 'Transaction Type', 'Album', 'Country'),
+]
+
+
+class RollupCube:
+    """Sums of Quantity and Subtotal of earnings data at several grain
+    levels, each a subset of the partner, period, transaction type, album,
+    track, ISRC and country dimensions.
+
+    The raw rows are aggregated once, to the finest grain, and every coarser
+    grain is rolled up from that. A query is answered from the smallest
+    grain that holds all the dimensions it groups or filters by:
+
+        cube = RollupCube.from_earnings_data(data)
+        cube.query(by=['Country'], **{'Company Name': 'Spotify', 'Album': 'X', 'Year': 2022})
+    """
+
+    def __init__(self, grains: dict):
+        # frames of sums keyed by their tuple of dimensions, smallest first
+        self.grains = dict(sorted(grains.items(), key=lambda item: len(item[1])))
+
+    @classmethod
+    def from_earnings_data(cls, data: pd.DataFrame, grains=DEFAULT_GRAINS) -> 'RollupCube':
+        """Builds a cube from loaded earnings data. Dimensions missing from
+        the data (e.g. in chunked or incremental aggregates) are left out.
+        """
+        dimensions = tuple(d for d in CUBE_DIMENSIONS if d in data.columns)
+        with instrumentation.stage('cube', rows=len(data)):
+            finest = _sum_by(data, dimensions)
+            cuboids = {dimensions: finest}
+            for grain in grains:
+                grain = tuple(d for d in grain if d in dimensions)
+                if grain not in cuboids:
+                    cuboids[grain] = _sum_by(finest, grain)
+        logger.info(
+            'Built rollup cube of %s rows with %s grain levels',
+            len(data), len(cuboids)
+        )
+        return cls(cuboids)
+
+    @property
+    def dimensions(self) -> tuple:
+        """All dimensions of the cube"""
+        return max(self.grains, key=len)
+
+    def grain_for(self, dimensions) -> tuple:
+        """The grain with the fewest rows that holds all of `dimensions`"""
+        needed = set(dimensions)
+        for grain in self.grains:
+            if needed <= set(grain):
+                return grain
+        raise KeyError(f'The cube has no dimensions {sorted(needed - set(self.dimensions))}')
+
+    def query(self, by=(), **filters) -> pd.DataFrame:
+        """Sums of Quantity and Subtotal, and the Rate (subtotal per unit),
+        grouped by the `by` dimensions, over the rows matching `filters`.
+
+        Each filter maps a dimension to a value or a list of values. Since
+        dimension names contain spaces, pass them with `**{...}`.
+        """
+        by = [by] if isinstance(by, str) else list(by)
+        sums = self.grains[self.grain_for(by + list(filters))]
+
+        mask = np.ones(len(sums), dtype=bool)
+        for dimension, value in filters.items():
+            column = sums[dimension]
+            if isinstance(value, (list, tuple, set, frozenset)):
+                mask &= column.isin(list(value)).to_numpy()
+            else:
+                mask &= (column == value).to_numpy()
+        selected = sums[mask]
+
+        if by:
+            result = _sum_by(selected, by).set_index(by)
+        else:
+            result = selected[REPORT_AGGREGATE_VALUES].sum().to_frame().T
+        with np.errstate(invalid='ignore', divide='ignore'):
+            result['Rate'] = result['Subtotal'] / result['Quantity'].where(result['Quantity'] != 0)
+        return result
+
+
+def _sum_by(data, dimensions) -> pd.DataFrame:
+    """Sums Quantity and Subtotal per combination of `dimensions` present
+    in the data, keeping rows with missing dimension values
+    """
+    values = data[REPORT_AGGREGATE_VALUES].astype(float, copy=False)
+    keys = [data[d] for d in dimensions]
+    return values.groupby(keys, observed=True, dropna=False, sort=False).sum().reset_index()
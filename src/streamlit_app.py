@@ -3,13 +3,20 @@ from pathlib import Path
 import streamlit as st
 from streamlit_echarts import st_echarts
 
-from data_loader import load_earnings_report
-from data_processor import generate_reports
+import cpi_prefetch
+from data_loader import detect_distributor
+from ingest_cache import fingerprint, load_earnings_report_cached
 from plotting import generate_echarts_rates_plot_options
+from report_cache import ReportCache
 from utils import convert_df_to_csv
 
 st.set_page_config(layout="wide")
 
+DISTRIBUTORS = {
+    'CD Baby': 'cd_baby',
+    'DistroKid': 'distrokid'
+}
+
 
 _sample_companies = ['Company A', 'Company B']
 _sample_data = []
@@ -48,6 +55,9 @@ DEFAULT_PLOT_OPTIONS = {
     "series": _sample_data
 }
 
+# Load CPI values in the background, so adjusting for inflation doesn't wait on them
+cpi_prefetch.start_prefetch()
+
 # Configure session state
 if 'data' not in st.session_state:
     st.session_state.data = _sample_data
@@ -68,17 +78,27 @@ if 'counts_plot_options' not in st.session_state:
 if 'distributor' not in st.session_state:
     st.session_state.distributor = 'CD Baby'
 
+# distributor of the loaded file, which may differ from the one selected
+if 'loaded_distributor' not in st.session_state:
+    st.session_state.loaded_distributor = st.session_state.distributor
+
 if 'earnings_data_file' not in st.session_state:
     st.session_state.earnings_data_file = None
 
 if 'raw_earnings_data' not in st.session_state:
     st.session_state.raw_earnings_data = None
 
+if 'raw_earnings_data_key' not in st.session_state:
+    st.session_state.raw_earnings_data_key = None
+
 if 'transactions' not in st.session_state:
     st.session_state.transactions = ['Stream']
 
 
 # Processed outputs
+if 'report_cache' not in st.session_state:
+    st.session_state.report_cache = ReportCache()
+
 if 'earnings_data' not in st.session_state:
     st.session_state.earnings_data = None
 
@@ -91,10 +111,7 @@ if 'counts_data' not in st.session_state:
 
 def load_earnings_data() -> None:
     """Load earnings data"""
-    distributor_map = {
-        'CD Baby': 'cd_baby', # TODO: add 'DistroKid': 'distrokid'
-    }
-    distributor_code = distributor_map.get(st.session_state.distributor)
+    distributor_code = DISTRIBUTORS.get(st.session_state.distributor)
     service_map_file = Path('data/partner_map_simplified.csv')
 
     if st.session_state.earnings_data_file:
@@ -102,14 +119,33 @@ def load_earnings_data() -> None:
     else:
         _file = 'data/sample_data/sample_data_cd_baby.txt'
 
-    st.session_state.raw_earnings_data = load_earnings_report(
-        _file, distributor_code, service_map_file
+    # the header of an upload tells which distributor it came from
+    try:
+        detected = detect_distributor(_file)
+    except ValueError as e:
+        st.error(str(e))
+        return
+    detected_label = next(label for label, code in DISTRIBUTORS.items() if code == detected)
+    if detected != distributor_code:
+        st.warning(f'This file looks like a {detected_label} export, so it was loaded as one.')
+        distributor_code = detected
+    st.session_state.loaded_distributor = detected_label
+
+    # skip loading entirely if the same file is already loaded
+    key = fingerprint(_file, distributor_code, service_map_file)
+    if key == st.session_state.raw_earnings_data_key:
+        return
+
+    st.session_state.raw_earnings_data = load_earnings_report_cached(
+        _file, distributor_code, service_map_file, key=key
     )
+    st.session_state.raw_earnings_data_key = key
+    cpi_prefetch.start_prefetch(st.session_state.raw_earnings_data)
 
 
 available_transactions = {
     'CD Baby': ['Stream', 'Download', 'Royalty', 'YouTube Audio Tier'],
-    # TODO: 'DistroKid': ['Stream', 'Download']
+    'DistroKid': ['Stream', 'Download']
 }
 
 
@@ -130,10 +166,12 @@ def run_report():
 
 
     # Generate summary report
-    summary_reports = generate_reports(
+    summary_reports = st.session_state.report_cache.get_reports(
+        st.session_state.raw_earnings_data_key,
         st.session_state.raw_earnings_data,
         transaction_codes,
-        adjust_for_inflation=st.session_state.adjust_for_inflation
+        adjust_for_inflation=st.session_state.adjust_for_inflation,
+        granularity=st.session_state.granularity.lower()
     )
 
     # Display plot
@@ -148,23 +186,28 @@ def run_report():
         st.session_state.rates_data = summary_reports['rates']
         st.session_state.earnings_data = summary_reports['earnings']
 
-    # rates
+    st.session_state.counts_data = summary_reports['counts']
+
+    # rates, with the long tail of partners averaged by transaction count
     st.session_state.rates_plot_options = generate_echarts_rates_plot_options(
         st.session_state.rates_data,
-        title_text=f'{transactions_str} Transactions - Rates{inflation_str}'
+        title_text=f'{transactions_str} Transactions - Rates{inflation_str}',
+        rollup='mean',
+        weights=st.session_state.counts_data
     )
 
     # earnings
     st.session_state.earnings_plot_options = generate_echarts_rates_plot_options(
         st.session_state.earnings_data,
-        title_text=f'{transactions_str} Transactions - Earnings{inflation_str}'
+        title_text=f'{transactions_str} Transactions - Earnings{inflation_str}',
+        rollup='sum'
     )
 
     # counts
-    st.session_state.counts_data = summary_reports['counts']
     st.session_state.counts_plot_options = generate_echarts_rates_plot_options(
         st.session_state.counts_data,
-        title_text=f'{transactions_str} Transactions - Counts'
+        title_text=f'{transactions_str} Transactions - Counts',
+        rollup='sum'
     )
 
     return
@@ -178,7 +221,7 @@ def display_sidebar():
 
         distributor = st.selectbox(
             label='**Step 1:** Select your distributor.', 
-            options=['CD Baby'], # TODO: add 'DistroKid'
+            options=list(DISTRIBUTORS),
             key='distributor'
         )
 
@@ -189,9 +232,15 @@ def display_sidebar():
         )
         load_earnings_data()
 
+        # offer the transaction types of the file as loaded, dropping any
+        # selected for a different distributor
+        transaction_options = available_transactions[st.session_state.loaded_distributor]
+        st.session_state.transactions = [
+            t for t in st.session_state.transactions if t in transaction_options
+        ]
         transactions = st.multiselect(
             label='**Step 3:** Which transaction types should be included in the report?',
-            options=available_transactions.get(distributor),
+            options=transaction_options,
             key='transactions'
         )
 
@@ -201,6 +250,12 @@ def display_sidebar():
             key='adjust_for_inflation'
         )
 
+        granularity = st.selectbox(
+            label='**Step 5:** Group results by',
+            options=['Year', 'Quarter', 'Month'],
+            key='granularity'
+        )
+
         run_report_button = st.button(
             label='Run Report!',
             on_click=run_report
@@ -19,6 +19,12 @@ def convert_df_to_csv(df: pd.DataFrame):
 def normalize_dataframe_values(df: pd.DataFrame, digits=5) -> pd.DataFrame:
     """Tries to cast all dataframe values as float and round all values
     """
+    try:
+        return df.astype(float).round(digits)
+    except ValueError:
+        pass
+
+    # fall back to one column at a time, leaving non-numeric columns as-is
     for c in df.columns:
         try:
             df[c] = df[c].astype(float).round(digits)
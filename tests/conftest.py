@@ -0,0 +1,131 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+from pathlib import Path
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import caching
+import cpi_prefetch
+from generate_sample_data import generate_sample_frame
+import inflation
+
+
+def cpi_value(year, month) -> float:
+    """CPI value served by the BLS stand-in for a month"""
+    return round(200 + (year - 2000) * 5 + month * 0.25, 3)
+
+
+class BLSStandIn:
+    """Records the requests made to a local stand-in for the BLS API and
+    answers them with CPI values from `cpi_value`
+    """
+
+    def __init__(self, last_year=2030):
+        self.requests = []
+        self.last_year = last_year
+        self.status = 'REQUEST_SUCCEEDED'
+        # answer successful requests without their Results, as a broken
+        # endpoint might
+        self.malformed = False
+
+    def respond(self, payload) -> dict:
+        self.requests.append((payload['startyear'], payload['endyear'], payload['registrationkey']))
+        if self.status != 'REQUEST_SUCCEEDED':
+            return {'status': self.status, 'message': ['Not processed'], 'Results': {}}
+        if self.malformed:
+            return {'status': self.status, 'message': []}
+        data = [
+            {'year': str(year), 'period': f'M{month:02d}', 'value': str(cpi_value(year, month))}
+            for year in range(payload['endyear'], payload['startyear'] - 1, -1)
+            if year <= self.last_year
+            for month in range(12, 0, -1)
+        ]
+        return {
+            'status': 'REQUEST_SUCCEEDED',
+            'message': [],
+            'Results': {'series': [{'seriesID': payload['seriesid'][0], 'data': data}]}
+        }
+
+
+@pytest.fixture
+def cpi_cache(tmp_path, monkeypatch):
+    """Keeps CPI values in a temporary cache database, and publishes CPI
+    indexes in a fresh prefetcher
+    """
+    monkeypatch.setattr(caching, 'LEGACY_CACHE_FILE', tmp_path / 'cpi_cache.json')
+    cached = caching.disk_cache(
+        inflation.get_cpi_values_for_year.__wrapped__,
+        ttl=inflation.cpi_cache_ttl,
+        db_path=tmp_path / 'cache.sqlite3'
+    )
+    monkeypatch.setattr(inflation, 'get_cpi_values_for_year', cached)
+    monkeypatch.setattr(cpi_prefetch, '_prefetcher', cpi_prefetch.CPIPrefetcher())
+    return cached
+
+
+@pytest.fixture
+def bls_api(cpi_cache, monkeypatch):
+    """A local stand-in for the BLS API that CPI requests are sent to"""
+    stand_in = BLSStandIn()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            body = json.dumps(stand_in.respond(payload)).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setenv('BLS_API_URL', f'http://127.0.0.1:{server.server_port}/')
+    monkeypatch.delenv('CPI_OFFLINE', raising=False)
+    monkeypatch.delenv('BLS_API_KEY', raising=False)
+    yield stand_in
+    server.shutdown()
+    server.server_close()
+
+
+SAMPLE_EXPORT = Path(__file__).resolve().parent.parent / 'data' / 'sample_data' / 'sample_data_cd_baby.txt'
+SERVICE_MAP_FILE = Path(__file__).resolve().parent.parent / 'data' / 'partner_map_simplified.csv'
+
+
+@pytest.fixture
+def split_exports(tmp_path) -> list:
+    """The sample CD Baby export split by album into two files, which share
+    report dates, as per-artist exports of one period do
+    """
+    export = pd.read_csv(SAMPLE_EXPORT, sep='\t', dtype=str)
+    albums = export['Album Name'].drop_duplicates()
+    first = export['Album Name'].isin(albums.iloc[::2])
+    paths = []
+    for name, part in (('first', export[first]), ('second', export[~first])):
+        path = tmp_path / f'{name}.txt'
+        part.to_csv(path, sep='\t', index=False)
+        paths.append(path)
+    return paths
+
+
+@pytest.fixture
+def write_export(tmp_path):
+    """Writes generated transactions in a distributor's export format, as
+    a tab-separated file or, for an .xlsx suffix, a spreadsheet
+    """
+    def write(distributor, suffix='.txt', rows=2000, name=None):
+        frame = generate_sample_frame(rows, distributor, rng=np.random.default_rng(1))
+        path = tmp_path / f'{name or distributor}{suffix}'
+        if suffix == '.xlsx':
+            frame.to_excel(path, index=False)
+        else:
+            frame.to_csv(path, sep='\t', index=False)
+        return path
+    return write
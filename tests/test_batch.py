@@ -0,0 +1,26 @@
+from click.testing import CliRunner
+
+import batch
+
+
+def test_job_names():
+    assert batch.job_name('exports/artist.txt') == 'artist'
+    assert batch.job_name('exports/artist') == 'artist'
+    assert batch.job_name('exports/artist/*.txt') == 'artist'
+    assert batch.job_name('exports/*/2023.txt') == 'exports'
+    assert batch.parse_input('band=exports/artist.txt') == ('band', 'exports/artist.txt')
+
+
+def test_repeated_job_names_are_rejected(tmp_path):
+    for directory in ('a', 'b'):
+        (tmp_path / directory).mkdir()
+        (tmp_path / directory / 'artist.txt').write_text('')
+
+    result = CliRunner().invoke(batch.main, [
+        str(tmp_path / 'a' / 'artist.txt'), str(tmp_path / 'b' / 'artist.txt'),
+        '--output-dir', str(tmp_path / 'reports')
+    ])
+
+    assert result.exit_code == 2
+    assert 'artist' in result.output
+    assert not (tmp_path / 'reports').exists()
@@ -0,0 +1,116 @@
+import io
+
+import pandas as pd
+import pytest
+
+from conftest import SAMPLE_EXPORT, SERVICE_MAP_FILE
+from data_loader import (
+    combine_earnings_reports, detect_distributor, load_earnings_report, load_earnings_reports,
+    read_header
+)
+from data_processor import generate_reports
+
+
+def test_split_exports_keep_all_rows(split_exports):
+    full = load_earnings_report(SAMPLE_EXPORT, 'cd_baby', SERVICE_MAP_FILE)
+    combined = load_earnings_reports(split_exports, 'cd_baby', SERVICE_MAP_FILE, max_workers=2)
+
+    assert len(combined) == len(full)
+    assert combined['Subtotal'].sum() == pytest.approx(full['Subtotal'].sum())
+
+
+def test_reimported_export_is_counted_once(split_exports):
+    first, second = (load_earnings_report(p, 'cd_baby', SERVICE_MAP_FILE) for p in split_exports)
+    full = load_earnings_report(SAMPLE_EXPORT, 'cd_baby', SERVICE_MAP_FILE)
+
+    assert len(combine_earnings_reports([first, first])) == len(first)
+    # the full export only adds the rows of the half not loaded yet
+    combined = combine_earnings_reports([first, full, second])
+    assert len(combined) == len(full)
+    assert combined['Subtotal'].sum() == pytest.approx(full['Subtotal'].sum())
+
+
+def test_repeated_rows_within_an_export_are_kept(split_exports):
+    first = load_earnings_report(split_exports[0], 'cd_baby', SERVICE_MAP_FILE)
+    doubled = combine_earnings_reports([first.iloc[[0, 0, 1]], first.iloc[[0, 1]]])
+
+    assert len(doubled) == 3
+
+
+@pytest.mark.parametrize('granularity', ['year', 'month'])
+@pytest.mark.parametrize('suffix', ['.txt', '.xlsx'])
+@pytest.mark.parametrize('distributor', ['cd_baby', 'distrokid'])
+def test_chunked_load_gives_the_same_reports(write_export, distributor, suffix, granularity):
+    path = write_export(distributor, suffix)
+    transactions = ('stream', 'download')
+
+    whole = generate_reports(
+        load_earnings_report(path, distributor, SERVICE_MAP_FILE),
+        transactions, adjust_for_inflation=False, granularity=granularity
+    )
+    chunked = generate_reports(
+        load_earnings_report(path, distributor, SERVICE_MAP_FILE, chunksize=300),
+        transactions, adjust_for_inflation=False, granularity=granularity
+    )
+
+    assert not whole['counts'].empty
+    assert whole.keys() == chunked.keys()
+    for name in whole:
+        pd.testing.assert_frame_equal(chunked[name], whole[name], check_dtype=False)
+
+
+@pytest.mark.parametrize('suffix', ['.txt', '.xlsx'])
+@pytest.mark.parametrize('distributor', ['cd_baby', 'distrokid'])
+def test_distributor_is_detected_from_the_header(write_export, distributor, suffix):
+    path = write_export(distributor, suffix, rows=50)
+    columns = list(pd.read_csv(path, sep='\t', nrows=0).columns) if suffix == '.txt' \
+        else list(pd.read_excel(path, nrows=0).columns)
+
+    assert read_header(path) == columns
+    assert detect_distributor(path) == distributor
+
+    # uploads are read from file objects, which are left where they were
+    upload = io.BytesIO(path.read_bytes())
+    upload.name = path.name
+    upload.seek(10)
+    assert detect_distributor(upload) == distributor
+    assert upload.tell() == 10
+
+
+def test_columns_are_selected_by_name(write_export, tmp_path):
+    path = write_export('cd_baby')
+    export = pd.read_csv(path, sep='\t', dtype=str)
+    reordered = export[export.columns[::-1]].rename(columns={'Partner Name': ' partner  NAME '})
+    reordered['Notes'] = 'extra'
+    reordered_path = tmp_path / 'reordered.txt'
+    reordered.to_csv(reordered_path, sep='\t', index=False)
+
+    expected = load_earnings_report(path, 'auto', SERVICE_MAP_FILE)
+    loaded = load_earnings_report(reordered_path, 'auto', SERVICE_MAP_FILE)
+    pd.testing.assert_frame_equal(loaded[expected.columns], expected)
+
+
+def test_missing_required_column_is_rejected(write_export, tmp_path):
+    export = pd.read_csv(write_export('cd_baby'), sep='\t', dtype=str)
+    path = tmp_path / 'no_quantity.txt'
+    export.drop(columns='Quantity').to_csv(path, sep='\t', index=False)
+
+    with pytest.raises(ValueError, match=r"missing the columns \['Quantity'\]"):
+        load_earnings_report(path, 'cd_baby', SERVICE_MAP_FILE)
+
+
+@pytest.mark.parametrize('suffix', ['.txt', '.xlsx'])
+def test_missing_dimension_columns_load_empty(write_export, tmp_path, suffix):
+    path = write_export('distrokid', '.txt', rows=200)
+    export = pd.read_csv(path, sep='\t').drop(columns='Country of Sale')
+    path = tmp_path / f'no_country{suffix}'
+    if suffix == '.xlsx':
+        export.to_excel(path, index=False)
+    else:
+        export.to_csv(path, sep='\t', index=False)
+
+    assert detect_distributor(path) == 'distrokid'
+    data = load_earnings_report(path, 'auto', SERVICE_MAP_FILE)
+    assert len(data) == 200
+    assert data['Country'].dtype == 'category'
+    assert data['Country'].isna().all()
@@ -0,0 +1,73 @@
+import pandas as pd
+import pytest
+
+from conftest import SAMPLE_EXPORT, SERVICE_MAP_FILE
+from data_loader import load_earnings_report
+from incremental import IncrementalReportStore, report_months
+
+
+def load(path):
+    return load_earnings_report(path, 'cd_baby', SERVICE_MAP_FILE)
+
+
+def test_refresh_with_export_sharing_report_dates(tmp_path, split_exports):
+    first, second = split_exports
+    store = IncrementalReportStore(tmp_path / 'store')
+    store.ingest(load(first))
+    store.save()
+
+    store = IncrementalReportStore(tmp_path / 'store')
+    assert store.ingest(load(second))
+
+    full = load(SAMPLE_EXPORT)
+    assert store.partial_sums['Quantity'].sum() == full['Quantity'].sum()
+    assert store.partial_sums['Subtotal'].sum() == pytest.approx(full['Subtotal'].sum())
+
+
+def test_reimported_rows_are_merged_once(tmp_path, split_exports):
+    store = IncrementalReportStore(tmp_path / 'store')
+    store.ingest(load(split_exports[0]))
+    totals = store.partial_sums.copy()
+
+    assert store.ingest(load(split_exports[0])) == set()
+    # an overlapping export only adds the rows not merged yet
+    assert store.ingest(load(SAMPLE_EXPORT))
+    assert store.partial_sums['Quantity'].sum() == load(SAMPLE_EXPORT)['Quantity'].sum()
+    assert totals['Quantity'].sum() < store.partial_sums['Quantity'].sum()
+
+
+def test_changed_service_map_does_not_double_count(tmp_path):
+    store = IncrementalReportStore(tmp_path / 'store')
+    store.ingest(load(SAMPLE_EXPORT))
+    store.save()
+    quantity = store.partial_sums['Quantity'].sum()
+
+    service_map = pd.read_csv(SERVICE_MAP_FILE)
+    service_map['Company Name'] = service_map['Company Name'].replace('Tidal', 'TIDAL')
+    renamed_map = tmp_path / 'partner_map.csv'
+    service_map.to_csv(renamed_map, index=False)
+
+    store = IncrementalReportStore(tmp_path / 'store')
+    assert store.ingest(load_earnings_report(SAMPLE_EXPORT, 'cd_baby', renamed_map)) == set()
+    assert store.partial_sums['Quantity'].sum() == quantity
+
+
+def test_refresh_only_rewrites_the_new_report_month(tmp_path):
+    full = load(SAMPLE_EXPORT)
+    months = report_months(full)
+    new_month = months.max()
+    store = IncrementalReportStore(tmp_path / 'store')
+    store.ingest(full[months != new_month])
+    store.save()
+    saved = {p.name: p.stat().st_mtime_ns for p in (tmp_path / 'store').iterdir()}
+    assert sorted(saved) == sorted(f'{m}.npz' for m in set(months) - {new_month})
+
+    store = IncrementalReportStore(tmp_path / 'store')
+    assert store.ingest(full[months == new_month])
+    store.save()
+
+    files = {p.name: p.stat().st_mtime_ns for p in (tmp_path / 'store').iterdir()}
+    assert files.keys() - saved.keys() == {f'{new_month}.npz'}
+    assert all(files[name] == mtime for name, mtime in saved.items())
+    assert store.partial_sums['Quantity'].sum() == full['Quantity'].sum()
+    assert store.partial_sums['Subtotal'].sum() == pytest.approx(full['Subtotal'].sum())
@@ -0,0 +1,104 @@
+from datetime import date
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import cpi_value
+import cpi_prefetch
+from data_processor import add_cpi_adjusted_reports
+import inflation
+
+
+def test_missing_years_are_requested_in_batches(bls_api):
+    values = inflation.get_cpi_values_for_years(2001, 2025)
+
+    assert [(start, end) for start, end, _ in bls_api.requests] == [
+        (2001, 2010), (2011, 2020), (2021, 2025)
+    ]
+    assert sorted(values) == list(range(2001, 2026))
+    assert len(values[2001]) == 12
+
+
+def test_registered_requests_cover_twenty_years(bls_api, monkeypatch):
+    monkeypatch.setenv('BLS_API_KEY', 'test-key')
+    inflation.get_cpi_values_for_years(2001, 2025)
+
+    assert bls_api.requests == [(2001, 2020, 'test-key'), (2021, 2025, 'test-key')]
+
+
+def test_cached_years_are_not_requested_again(bls_api):
+    inflation.get_cpi_values_for_years(2010, 2015)
+    inflation.get_cpi_values_for_years(2012, 2018)
+
+    assert [(start, end) for start, end, _ in bls_api.requests] == [(2010, 2015), (2016, 2018)]
+
+
+@pytest.mark.parametrize('status, malformed', [
+    ('REQUEST_NOT_PROCESSED', False),
+    ('REQUEST_FAILED_INVALID_PARAMETERS', False),
+    ('REQUEST_SUCCEEDED', True),
+])
+def test_failed_requests_fall_back_to_snapshot(bls_api, status, malformed):
+    bls_api.status, bls_api.malformed = status, malformed
+    values = inflation.get_cpi_values_for_years(2020, 2021)
+
+    assert bls_api.requests
+    assert values == inflation.load_cpi_snapshot([2020, 2021])
+    # snapshot values are not cached, so the API is tried again next time
+    assert not inflation.get_cpi_values_for_year.is_cached(2020)
+
+
+def test_prefetcher_index_falls_back_to_snapshot(bls_api):
+    bls_api.status = 'REQUEST_FAILED_INVALID_PARAMETERS'
+    index = cpi_prefetch.get_index(2020, 2021)
+
+    snapshot = inflation.load_cpi_snapshot([2020])[2020]
+    january = next(d for d in snapshot if d['period'] == 'M01')
+    assert index.lookup(2020, 1) == float(january['value'])
+
+
+def test_offline_mode_reads_snapshot_without_requests(bls_api, monkeypatch):
+    monkeypatch.setenv('CPI_OFFLINE', '1')
+    values = inflation.get_cpi_values_for_years(2020, 2021)
+
+    assert bls_api.requests == []
+    assert values == inflation.load_cpi_snapshot([2020, 2021])
+
+
+def test_cpi_index_lookup_and_last_month(bls_api):
+    bls_api.last_year = 2022
+    index = inflation.get_cpi_index(2020, 2023)
+
+    assert index.lookup(2021, 7) == cpi_value(2021, 7)
+    assert index.last_month == (2022, 12)
+    # gaps are filled from the most recent month, within the look-back window
+    assert index.lookup(2023, 5) == cpi_value(2022, 12)
+    assert index.lookup(2023, 6) is None
+
+
+def test_adjusted_reports_clamp_target_date_to_latest_cpi(bls_api):
+    bls_api.last_year = 2022
+    reports = {
+        'rates': pd.DataFrame({2021: [1.0], 2022: [2.0]}, index=['Spotify']),
+        'earnings': pd.DataFrame({2021: [10.0], 2022: [20.0]}, index=['Spotify']),
+    }
+    add_cpi_adjusted_reports(reports, date(2024, 6, 30))
+
+    adjusted = reports['cpi_adjusted_earnings']
+    assert not adjusted.isna().any().any()
+    average_2021 = np.mean([cpi_value(2021, m) for m in range(1, 13)])
+    expected = 10.0 * cpi_value(2022, 12) / average_2021
+    assert adjusted.loc['Spotify', 2021] == pytest.approx(expected, abs=0.01)
+
+
+def test_adjusted_reports_offline_use_snapshot(cpi_cache, monkeypatch):
+    monkeypatch.setenv('CPI_OFFLINE', '1')
+    reports = {
+        'rates': pd.DataFrame({2020: [0.004]}, index=['Spotify']),
+        'earnings': pd.DataFrame({2020: [100.0]}, index=['Spotify']),
+    }
+    add_cpi_adjusted_reports(reports)
+
+    assert not reports['cpi_adjusted_earnings'].isna().any().any()
+    assert not reports['cpi_adjusted_rates'].isna().any().any()
@@ -0,0 +1,33 @@
+import io
+import os
+
+import ingest_cache
+
+
+def test_content_hash_is_remembered_until_the_file_changes(tmp_path, monkeypatch):
+    path = tmp_path / 'export.txt'
+    path.write_text('a\tb\n1\t2\n')
+    reads = []
+    update_hash = ingest_cache._update_hash
+    monkeypatch.setattr(
+        ingest_cache, '_update_hash', lambda digest, source: reads.append(source) or update_hash(digest, source)
+    )
+
+    first = ingest_cache.content_hash(path)
+    assert ingest_cache.content_hash(path) == first
+    assert len(reads) == 1
+
+    path.write_text('a\tb\n1\t3\n')
+    os.utime(path, ns=(0, path.stat().st_mtime_ns + 1))
+    assert ingest_cache.content_hash(path) != first
+    assert len(reads) == 2
+
+
+def test_uploads_are_hashed_once_per_file_id():
+    upload = io.BytesIO(b'a\tb\n1\t2\n')
+    upload.file_id, upload.name, upload.size = 'upload-1', 'export.txt', 8
+    anonymous = io.BytesIO(b'a\tb\n1\t2\n')
+
+    assert ingest_cache.content_hash(upload) == ingest_cache.content_hash(anonymous)
+    assert ingest_cache._hash_key(upload) in ingest_cache._content_hashes
+    assert ingest_cache._hash_key(anonymous) is None
@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+import instrumentation
+
+
+@pytest.fixture
+def metrics():
+    instrumentation.reset()
+    instrumentation.enable()
+    yield
+    instrumentation.disable()
+    instrumentation.reset()
+
+
+@pytest.mark.skipif(instrumentation.resource is None, reason='needs the resource module')
+def test_stages_record_their_own_peak_rss_growth(metrics):
+    # enough to go past the peak reached by anything run before
+    large = int((instrumentation.peak_rss_mb() + 200) * 1e6)
+    with instrumentation.stage('large'):
+        np.ones(large // 8).sum()
+    with instrumentation.stage('small'):
+        np.ones(30_000_000 // 8).sum()
+
+    stages = instrumentation.snapshot()['stages']
+    assert stages['large']['peak_rss_growth_mb'] > 100
+    # below the peak the large stage reached, so it does not raise it
+    assert stages['small']['peak_rss_growth_mb'] < 10
+
+
+def test_prometheus_export(metrics):
+    with instrumentation.stage('load', rows=10):
+        pass
+    instrumentation.record_cache('ingest', hit=False)
+
+    text = instrumentation.to_prometheus()
+    assert 'soc_stage_calls_total{stage="load"} 1' in text
+    assert 'soc_stage_rows_total{stage="load"} 10' in text
+    assert 'soc_cache_misses_total{cache="ingest"} 1' in text
+    assert 'soc_stage_peak_rss_megabytes' not in text
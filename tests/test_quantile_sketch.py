@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+
+from conftest import SAMPLE_EXPORT, SERVICE_MAP_FILE
+from data_loader import load_earnings_report
+from data_processor import generate_reports
+from quantile_sketch import DEFAULT_RELATIVE_ACCURACY, RateSketch, quantile_name
+
+QUANTILES = (0.1, 0.5, 0.9)
+
+
+def load(**options):
+    return load_earnings_report(SAMPLE_EXPORT, 'cd_baby', SERVICE_MAP_FILE, **options)
+
+
+def weighted_quantiles(group) -> pd.Series:
+    """Exact quantiles of the per-unit rates of a group of transactions,
+    weighted by quantity
+    """
+    rates = (group['Subtotal'] / group['Quantity']).to_numpy()
+    order = np.argsort(rates)
+    cumulative = np.cumsum(group['Quantity'].to_numpy()[order])
+    return pd.Series({
+        quantile_name(q): rates[order][np.searchsorted(cumulative, q * cumulative[-1])]
+        for q in QUANTILES
+    })
+
+
+def test_rate_quantiles_are_within_relative_accuracy():
+    data = load()
+    reports = generate_reports(data, ('stream',), adjust_for_inflation=False, rate_quantiles=QUANTILES)
+
+    streams = data[(data['Transaction Type'] == 'stream') & (data['Quantity'] > 0)]
+    exact = streams.groupby(['Company Name', 'Year'], observed=True)[['Subtotal', 'Quantity']].apply(
+        weighted_quantiles
+    )
+    for q in QUANTILES:
+        name = quantile_name(q)
+        estimate = reports[name].stack()
+        expected = exact[name].reindex(estimate.index)
+        assert len(estimate) == len(exact)
+        # reports are rounded to 5 digits
+        np.testing.assert_allclose(estimate, expected, rtol=DEFAULT_RELATIVE_ACCURACY, atol=1e-5)
+
+
+def test_merged_chunk_sketches_equal_the_whole_export_sketch():
+    data = load()
+    whole = RateSketch().update(data)
+
+    half = len(data) // 2
+    merged = RateSketch().update(data.iloc[:half]).merge(RateSketch().update(data.iloc[half:]))
+    pd.testing.assert_series_equal(merged.counts.sort_index(), whole.counts.sort_index())
+
+    chunked = RateSketch()
+    load(chunksize=5000, sketch=chunked)
+    pd.testing.assert_series_equal(chunked.counts.sort_index(), whole.counts.sort_index())